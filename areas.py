@@ -8,35 +8,34 @@ https://github.com/hhru/api/blob/master/docs_eng/README.md
 https://github.com/hhru/api/blob/master/docs_eng/vacancies.md
 """
 
-from copy import deepcopy
-import sqlite3
-import time
 import types
 
 from inputimeout import inputimeout, TimeoutOccurred
-import requests
 
+from logs import logger
 from shared import (
     create_table,
     create_table_columns,
+    get_connection,
     get_table_columns_names,
-    write_to_database,
+    http_get,
+    is_table_exists,
+    transaction,
+    write_many_to_database,
     write_to_file
 )
 import tests.input_tests as in_tests
 import tests.output_tests as out_tests
 
-def load_areas(config):
+def load_areas(snapshot):
     """
     Get json with geo (countries, regions, cities) and their ids.
     We'll write this json to sqlite database to search by areas.
     """
-    headers = deepcopy(config["headers"])
-    in_tests.test_dict_data_type(headers)
-    print ("\n\n    Loading areas from hh...")
+    logger.info("\n\n    Loading areas from hh...")
 
     url = "https://api.hh.ru/areas"
-    response = requests.get(url, headers=headers)
+    response = http_get(snapshot, url)
     areas = response.json()
     out_tests.test_load_areas(response, areas)
     return (areas)
@@ -58,34 +57,35 @@ def create_areas_generator(areas):
         for item in areas:
             yield from create_areas_generator(item)
     else:
-        print (f"\n\n    Unhandled data type: {type(areas)}\n\n")
+        logger.error(f"\n\n    Unhandled data type: {type(areas)}\n\n")
         raise TypeError
 
-def get_areas(config):
+def get_areas(snapshot):
     """
     Load areas from hh, save them to file (for debugging) and database.
     """
-    areas_file = deepcopy(config["areas_file"])
-    print ("\n\nGetting areas from hh. \
-It is one time operation and can take up to several minutes...\n")
-    time.sleep(5)
+    areas_file = snapshot.areas_file
+    logger.info("\n\nGetting areas from hh. \
+It is one time operation and can take a few seconds...\n")
 
-    areas = load_areas(config)
+    areas = load_areas(snapshot)
     write_to_file(areas_file, areas)
-    write_areas_to_database(config, create_areas_generator(areas))
+    write_areas_to_database(snapshot, create_areas_generator(areas))
     return ()
 
-def write_areas_to_database(config, areas_generator):
+def write_areas_to_database(snapshot, areas_generator, batch_size=1000):
     """
-    Iterate over areas generator and fill the table.
+    Iterate over areas generator and fill the table
+    with `batch_size` rows per `executemany` in one transaction.
     """
-    database = deepcopy(config["database"])
-    table = deepcopy(config["tables"]["areas_table"])
+    database = snapshot.database
+    table = snapshot.tables.areas_table
     in_tests.test_database_name(database)
     in_tests.test_table_name(table)
     in_tests.test_var_type(
         areas_generator, "areas_generator", types.GeneratorType)
-    print (f"\n\n    Writing geo areas to `{database} > {table}`...")
+    in_tests.test_var_type(batch_size, "batch_size", int)
+    logger.info(f"\n\n    Writing geo areas to `{database} > {table}`...")
 
     create_table(database, table,\
         ["id INT NOT NULL PRIMARY KEY",\
@@ -95,32 +95,39 @@ def write_areas_to_database(config, areas_generator):
 
     columns_names = get_table_columns_names(database, table)
     area = {}
+    areas_rows = []
     areas_counter = 0
     database_changes = 0
 
-    for item in areas_generator:
-        key, value = item[0], item[1]
+    with transaction(database):
+        for item in areas_generator:
+            key, value = item[0], item[1]
 
-        # Lowercase text to have case-insensitive search.
-        # `COLLATE NOCASE` doesn't work for cyrillic.
-        try:
-            value = value.lower()
-        except AttributeError:
-            pass
+            # Lowercase text to have case-insensitive search.
+            # `COLLATE NOCASE` doesn't work for cyrillic.
+            try:
+                value = value.lower()
+            except AttributeError:
+                pass
 
-        if key not in columns_names:
-            column = [(f"{key} TEXT")]
-            create_table_columns(database, table, column)
-            columns_names.append(key)
+            if key not in columns_names:
+                column = [(f"{key} TEXT")]
+                create_table_columns(database, table, column)
+                columns_names.append(key)
 
-        if key != "id" or area == {}:
-            area[key] = value
-        else:
-            database_changes += write_to_database(database, table, area)
-            areas_counter += 1
-            area[key] = value
-    database_changes += write_to_database(database, table, area)
-    areas_counter += 1
+            if key != "id" or area == {}:
+                area[key] = value
+            else:
+                areas_rows.append(area)
+                areas_counter += 1
+                area = {key: value}
+                if len(areas_rows) >= batch_size:
+                    database_changes += write_many_to_database(
+                        database, table, areas_rows)
+                    areas_rows = []
+        areas_rows.append(area)
+        areas_counter += 1
+        database_changes += write_many_to_database(database, table, areas_rows)
     out_tests.test_write_to_database(database_changes, areas_counter)
     return ()
 
@@ -151,13 +158,13 @@ I can understand:\n\
     out_tests.test_get_user_inputs(user_areas)
     return (user_areas)
 
-def search_user_areas(config):
+def search_user_areas(snapshot, config):
     """
     Search names and ids for user areas and confirm results.
     """
-    database = deepcopy(config["database"])
-    areas_table = deepcopy(config["tables"]["areas_table"])
-    saved_areas = deepcopy(config["url_params"]["area"][-1]).split("|")
+    database = snapshot.database
+    areas_table = snapshot.tables.areas_table
+    saved_areas = config["url_params"]["area"][-1].split("|")
     in_tests.test_table_name(areas_table)
     in_tests.test_var_type(saved_areas, "saved_areas", (list, type(None)))
 
@@ -213,6 +220,14 @@ Auto-apply in {timeout} sec...")
         else:
                print (f"\n\n    Unhandled user_confirm: {user_confirm}\n\n")
                raise ValueError
+    config = set_user_areas(config, found, found_ids)
+    return (config)
+
+def set_user_areas(config, found, found_ids):
+    """
+    Remove children areas and set the rest as
+    `filters > {areas_table}.id` and `url_params > area`.
+    """
     cleaned, cleaned_ids = clean_area_children(
         found, found_ids)
 
@@ -222,6 +237,64 @@ Auto-apply in {timeout} sec...")
         config["filters"]["{areas_table}.id"]
     return (config)
 
+def select_headless_area(database, areas_table, user_area):
+    """
+    Select exactly one area by id or name without asking user.
+    Name must match one area or one area exactly, else raise ValueError
+    with one line reason.
+    Return area tuple (`id`, `parent_id`, `name`).
+    """
+    if user_area.isdigit():
+        not_found, found = \
+            select_areas_by_ids(database, areas_table, [int(user_area)])
+    else:
+        not_found, found, found_ids = \
+            select_areas_by_name(database, areas_table, [user_area])
+    if not found:
+        raise ValueError(f"Region `{user_area}` is not found \
+in {database} > {areas_table}.")
+    exact = [area for area in found if area[2] == user_area.lower()]
+    if len(found) == 1 or len(exact) == 1:
+        return ((exact or list(found))[0])
+    candidates = sorted(found, key=lambda area: area[2])
+    raise ValueError(f"Region `{user_area}` is ambiguous, it matches \
+{len(candidates)} regions: " + ", ".join(
+        f"{area[0]} ({area[2]})" for area in candidates[:10]) +
+                     ". Use region id or full name.")
+
+def resolve_headless_areas(snapshot, config, user_areas=None):
+    """
+    Resolve user areas without prompts and timeouts:
+    `user_areas` (names or ids from command line) or saved ones.
+    Fail fast with ValueError if a region is not found or ambiguous.
+    """
+    database = snapshot.database
+    areas_table = snapshot.tables.areas_table
+    saved_areas = config["url_params"]["area"][-1].split("|")
+    in_tests.test_table_name(areas_table)
+    logger.info("\n\nResolving regions without prompts...")
+
+    if user_areas is None:
+        user_areas = [saved_area for saved_area in saved_areas if saved_area]
+    else:
+        in_tests.test_area_names(user_areas)
+    found = set()
+    for user_area in user_areas:
+        found.add(select_headless_area(database, areas_table, user_area))
+    found_ids = set(area[0] for area in found)
+
+    saved_ids = set(int(saved_area) for saved_area in saved_areas
+                    if saved_area)
+    config = set_user_areas(config, found, found_ids)
+    new_ids = set(int(new_area) for new_area in
+                  config["url_params"]["area"][-1].split("|") if new_area)
+    if new_ids != saved_ids:
+        # New regions: search them for `period` instead of since last session.
+        config["url_params"].pop("date_from", None)
+    logger.info("    Regions: " + (", ".join(sorted(
+        area[2] for area in found if area[0] in new_ids)) or "All regions"))
+    return (config)
+
 def select_areas_by_name(database, table, names):
     """
     Select geo areas by name to get their ids.
@@ -230,9 +303,9 @@ def select_areas_by_name(database, table, names):
     in_tests.test_database_name(database)
     in_tests.test_table_name(table)
     in_tests.test_area_names(names)
-    print ("\n\nSearching geo areas...")
+    logger.info("\n\nSearching geo areas...")
 
-    connection = sqlite3.connect(database)
+    connection = get_connection(database)
     cursor = connection.cursor()
     query = f"SELECT * FROM {table} WHERE name LIKE ?"
     not_found, found, found_ids = set(), set(), set()
@@ -248,7 +321,6 @@ def select_areas_by_name(database, table, names):
                 found.add(found_area)
                 found_ids.add(found_area[0])
     cursor.close()
-    connection.close()
     out_tests.test_select_areas_by_name(not_found, found, found_ids)
     return (not_found, found, found_ids)
 
@@ -261,7 +333,7 @@ def select_areas_by_ids(database, table, areas_ids):
     in_tests.test_table_name(table)
     in_tests.test_list_data_type(areas_ids)
 
-    connection = sqlite3.connect(database)
+    connection = get_connection(database)
     cursor = connection.cursor()
     query = f"SELECT * FROM {table} WHERE id == ?"
     not_found, found = set(), set()
@@ -274,7 +346,6 @@ def select_areas_by_ids(database, table, areas_ids):
         else:
             found.add(found_area[0])
     cursor.close()
-    connection.close()
     out_tests.test_select_areas_by_ids(not_found, found)
     return (not_found, found)
 
@@ -301,34 +372,43 @@ def clean_area_children(found, found_ids):
     out_tests.test_clean_area_children(found, cleaned, duplicated)
     return (cleaned, cleaned_ids)
 
-def check_if_area_id_is_in_areas_table(config, area_id):
+def select_areas_ids(database, table):
     """
-    1. Check if area_id is in `areas_table`.
-    2. If not -> update `areas_table` by calling `get_areas`
-    3. Check if area_id is in `areas_table`.
-    4. If yes -> return True, else -> raise
+    Select all geo areas ids at once to check vacancies areas in memory.
+    Return set of ints, empty if table doesn't exist.
     """
-    database = deepcopy(config["database"])
-    areas_table = deepcopy(config["tables"]["areas_table"])
     in_tests.test_database_name(database)
-    in_tests.test_table_name(areas_table)
-    in_tests.test_var_type(area_id, "area_id", int)
-    print (f"    Checking if area_id is in {database} > {areas_table}...")
+    in_tests.test_table_name(table)
 
-    connection = sqlite3.connect(database)
+    if not is_table_exists(database, table):
+        return (set())
+    connection = get_connection(database)
     cursor = connection.cursor()
-    query = f"SELECT EXISTS (SELECT 1 FROM {areas_table} WHERE id == {area_id})"
-    is_area_id_in_areas_table = cursor.execute(query).fetchall()[0][0]
-    if not is_area_id_in_areas_table:
-        get_areas(config)
-        is_area_id_in_areas_table = cursor.execute(query).fetchall()[0][0]
-    if not is_area_id_in_areas_table:
-        cursor.close()
-        connection.close()
-        print (f"\n\n    I've updated areas but couldn't find id == \
-{area_id} in {areas_table}.\n\n")
+    query = f"SELECT id FROM {table}"
+    areas_ids = set(row[0] for row in cursor.execute(query))
+    cursor.close()
+    out_tests.test_var_type(areas_ids, "areas_ids", set)
+    return (areas_ids)
+
+def update_areas_with_unknown_ids(snapshot, unknown_ids):
+    """
+    1. Update `areas_table` by calling `get_areas` once for all `unknown_ids`.
+    2. If some ids are still not in `areas_table` -> raise.
+    Return updated set of all areas ids.
+    """
+    database = snapshot.database
+    areas_table = snapshot.tables.areas_table
+    in_tests.test_database_name(database)
+    in_tests.test_table_name(areas_table)
+    in_tests.test_var_type(unknown_ids, "unknown_ids", set)
+    logger.warning(f"\n\n    Areas ids {sorted(unknown_ids)} are not in \
+{database} > {areas_table}. Updating areas...")
+
+    get_areas(snapshot)
+    areas_ids = select_areas_ids(database, areas_table)
+    still_unknown_ids = unknown_ids - areas_ids
+    if still_unknown_ids:
+        logger.error(f"\n\n    I've updated areas but couldn't find ids == \
+{sorted(still_unknown_ids)} in {areas_table}.\n\n")
         raise ValueError
-    else:
-        cursor.close()
-        connection.close()
-        return (True)
+    return (areas_ids)
@@ -1,9 +1,11 @@
  #!/usr/bin/env python3.6
 
 """
-Read and write config.yaml
+Read config.yaml. It is read-only: runtime state is in `state.py`.
+Sessions pass settings to per-page and per-row functions as immutable
+`ConfigSnapshot` instead of copying them out of config on every call.
 """
-from copy import deepcopy
+from typing import NamedTuple, Tuple
 
 from ruamel.yaml import YAML
 
@@ -23,33 +25,120 @@ def read_config(config_path="config.yaml"):
     out_tests.test_dict_data_type(config)
     return (config)
 
-def write_config(edited_config, config_path="config.yaml"):
+class Tables(NamedTuple):
     """
-    Well... write to config file.
+    `config.yaml > tables`.
     """
-    in_tests.test_read_config(config_path)
-    in_tests.test_dict_data_type(edited_config)
+    areas_table: str
+    vacancies_table: str
+    streets_table: str
+    metro_stations_table: str
+    employers_table: str
+    vacancies_metro_stations_table: str
 
-    with open (config_path, "w", encoding="utf8") as f:
-        yaml = YAML()
-        yaml.default_flow_style = False
-        yaml.width = 80
-        yaml.dump(edited_config, f)
-    out_tests.test_write_config(edited_config)
-    return ()
+class HttpClient(NamedTuple):
+    """
+    `config.yaml > http_client`.
+    """
+    pool_size: int
+    connect_timeout: float
+    read_timeout: float
+    rate_limit: float
+    burst: int
+    max_retries: int
+    backoff: float
+
+class TelegramClient(NamedTuple):
+    """
+    `config.yaml > telegram_client`.
+    """
+    pool_size: int
+    concurrency: int
+    connect_timeout: float
+    read_timeout: float
+    rate_limit: float
+    burst: int
+    chat_rate_limit: float
+    chat_burst: int
+    max_retries: int
+    backoff: float
+    outbox_batch_size: int
+    max_attempts: int
+
+class Daemon(NamedTuple):
+    """
+    `config.yaml > daemon`.
+    """
+    interval: float
+    jitter: float
 
-def import_database_columns(config, config_path="config.yaml"):
+class ConfigSnapshot(NamedTuple):
     """
-    Get all database columns and write them to config as available to filters.
+    Immutable settings of one process (see `get_config_snapshot`).
     """
-    database = deepcopy(config["database"])
+    database: str
+    tables: Tables
+    state_table: str
+    outbox_table: str
+    areas_file: str
+    vacancies_file: str
+    clean_vacancies_file_path: str
+    dirty_vacancies_file_path: str
+    income_tax: float
+    chat_id: int
+    digest: bool
+    kill_program_after: int
+    concurrency: int
+    incremental: bool
+    http_client: HttpClient
+    telegram_client: TelegramClient
+    daemon: Daemon
+    # `config.yaml > headers` as tuple of (header, value).
+    headers: Tuple[Tuple[str, str], ...]
+
+def get_config_snapshot(config):
+    """
+    Parse settings from config once per process into `ConfigSnapshot`.
+    Runtime state (`url_params`, `filters`, `high_water_mark`)
+    stays in config.
+    """
+    out_tests.test_dict_data_type(config)
+
+    snapshot = ConfigSnapshot(
+        database=config["database"],
+        tables=Tables(**config["tables"]),
+        state_table=config["state_table"],
+        outbox_table=config["outbox_table"],
+        areas_file=config["areas_file"],
+        vacancies_file=config["vacancies_file"],
+        clean_vacancies_file_path=config["clean_vacancies_file_path"],
+        dirty_vacancies_file_path=config["dirty_vacancies_file_path"],
+        income_tax=config["income_tax"],
+        chat_id=config["chat_id"],
+        digest=config["digest"],
+        kill_program_after=config["kill_program_after"],
+        concurrency=config["concurrency"],
+        incremental=config["incremental"],
+        http_client=HttpClient(**config["http_client"]),
+        telegram_client=TelegramClient(**config["telegram_client"]),
+        daemon=Daemon(**config["daemon"]),
+        headers=tuple(config["headers"].items())
+    )
+    in_tests.test_database_name(snapshot.database)
+    for table in snapshot.tables:
+        in_tests.test_table_name(table)
+    in_tests.test_table_name(snapshot.state_table)
+    in_tests.test_table_name(snapshot.outbox_table)
+    return (snapshot)
+
+def select_database_columns(snapshot):
+    """
+    Get all database columns available to filters: {table: [columns]}.
+    """
+    database = snapshot.database
     in_tests.test_database_name(database)
-    in_tests.test_read_config(config_path)
-    print (f"\nUpdating {config_path}")
 
     columns = {}
-    for table in config["tables"].values():
+    for table in snapshot.tables:
         columns[table] = get_table_columns_names(database, table)
-    config["filters_columns"] = columns
-    write_config(config)
     return (columns)
@@ -1,2 +1,2 @@
 chdir /d "D:\onedrive\documents\projects\hh_parser"
-"C:\Users\kkecher\AppData\Local\Programs\Python\Python37-32\python" "main.py"
+"C:\Users\kkecher\AppData\Local\Programs\Python\Python37-32\python" "main.py" --headless
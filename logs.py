@@ -0,0 +1,132 @@
+#!/usr/bin/env python3.6
+
+"""
+Leveled logging for hh_parser.
+
+Per-row and per-request events are DEBUG records. Stages (`http`,
+`ingest`, `database`, `telegram`) add numbers to counters instead and log
+one INFO summary line per session (see `log_stage_counters`).
+Records go to console and, if `config.yaml > logging > file` is set,
+to JSON-lines file with buffered writes.
+"""
+
+from collections import Counter, defaultdict
+from pathlib import Path
+import datetime
+import json
+import logging
+import sys
+import threading
+
+import tests.input_tests as in_tests
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+logger = logging.getLogger("hh_parser")
+# Logger is quiet until `setup_logging` (unit tests and benchmarks).
+logger.addHandler(logging.NullHandler())
+
+stage_counters = defaultdict(Counter)
+_stage_counters_lock = threading.Lock()
+
+class JsonLinesHandler(logging.Handler):
+    """
+    Write records as JSON lines to `file_name`.
+    Lines are buffered and written by `buffer_size` at once,
+    ERROR records and `close` write the buffer immediately.
+    """
+    def __init__(self, file_name, buffer_size):
+        super().__init__()
+        self.file_name = file_name
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def emit(self, record):
+        line = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "module": record.module,
+            "message": record.getMessage().strip()
+        }
+        if hasattr(record, "stage"):
+            line["stage"] = record.stage
+            line["counters"] = record.counters
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        self.acquire()
+        try:
+            self.buffer.append(json.dumps(line, ensure_ascii=False))
+            is_full = len(self.buffer) >= self.buffer_size
+        finally:
+            self.release()
+        if is_full or record.levelno >= logging.ERROR:
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                with open(self.file_name, "a", encoding="utf8") as f:
+                    f.write("\n".join(self.buffer) + "\n")
+                self.buffer = []
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        super().close()
+
+def setup_logging(config):
+    """
+    Set console and JSON-lines file handlers from `config.yaml > logging`.
+    """
+    level = config["logging"]["level"]
+    file_name = config["logging"]["file"]
+    file_level = config["logging"]["file_level"]
+    buffer_size = config["logging"]["buffer_size"]
+    assert level in LOG_LEVELS and file_level in LOG_LEVELS, \
+        f"\n\nExpected logging levels in {LOG_LEVELS}.\n\
+Got `{level}` and `{file_level}`."
+    in_tests.test_var_type(buffer_size, "buffer_size", int)
+
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(level)
+    console_handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(console_handler)
+    logger_level = logging.getLevelName(level)
+    if file_name:
+        in_tests.test_write_to_file_file_name(file_name)
+        Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+        file_handler = JsonLinesHandler(file_name, buffer_size)
+        file_handler.setLevel(file_level)
+        logger.addHandler(file_handler)
+        logger_level = min(logger_level, logging.getLevelName(file_level))
+    logger.setLevel(logger_level)
+    logger.propagate = False
+    return ()
+
+def count_stage(stage, counter, number=1):
+    """
+    Add `number` to `counter` of `stage`.
+    """
+    with _stage_counters_lock:
+        stage_counters[stage][counter] += number
+    return ()
+
+def log_stage_counters(stage):
+    """
+    Log one summary line of `stage` counters and reset them.
+    """
+    with _stage_counters_lock:
+        counters = dict(stage_counters.pop(stage, {}))
+    if not counters:
+        return ()
+    logger.info(
+        f"{stage}: " + ", ".join(
+            f"{counter} {number}" for counter, number in counters.items()),
+        extra={"stage": stage, "counters": counters})
+    return ()
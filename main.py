@@ -2,34 +2,141 @@
 
 """
 Main module for hh_parser project.
+
+Usage:
+    python main.py            # one session (e.g. from cron)
+    python main.py --daemon   # keep running sessions on internal schedule
+    python main.py --headless [--areas москва 2]
+                              # no prompts: saved or given regions
 """
 
-from copy import deepcopy
+from pathlib import Path
+import argparse
+import random
+import time
 
-from areas import get_areas, search_user_areas
-from config import read_config, write_config
-from shared import is_table_exists
+from areas import get_areas, resolve_headless_areas, search_user_areas
+from config import get_config_snapshot, read_config
+from logs import logger, setup_logging
+from shared import (
+    close_connections,
+    is_table_exists,
+    reset_http_latencies,
+    single_instance_lock
+)
+from state import load_state, save_state
 from telegram import send_to_telegram
+from tests.validation import set_validation_level
 from vacancies import get_vacancies
+import tests.input_tests as in_tests
+
+def parse_args():
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description=
+        "Get hh vacancies, filter them and send to Telegram.")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="keep running sessions every `config.yaml > daemon > interval` \
+seconds instead of one session")
+    parser.add_argument(
+        "--headless", action="store_true",
+        help="don't ask anything: use saved regions or `--areas` and exit \
+with error if a region is not found or ambiguous")
+    parser.add_argument(
+        "--areas", nargs="+", metavar="AREA",
+        help="regions names or ids for `--headless` mode")
+    args = parser.parse_args()
+    if args.areas and not args.headless:
+        parser.error("--areas requires --headless")
+    return (args)
+
+def run_session(snapshot, config):
+    """
+    Get new vacancies, filter them and send to Telegram.
+    """
+    reset_http_latencies()
+    get_vacancies(snapshot, config)
+    send_to_telegram(snapshot, config)
+    return ()
+
+def run_daemon(snapshot, config):
+    """
+    Run sessions every `config.yaml > daemon > interval` seconds
+    (+- random `jitter` seconds) until interrupted.
+    Process, HTTP sessions and database connections are kept warm.
+    Failed session (network, locked database, unexpected hh response,
+    failed runtime test) is logged and retried next time.
+    """
+    interval = snapshot.daemon.interval
+    jitter = snapshot.daemon.jitter
+    kill_program_after = snapshot.kill_program_after
+    in_tests.test_var_type(interval, "interval", (int, float))
+    in_tests.test_var_type(jitter, "jitter", (int, float))
+    if interval <= kill_program_after + jitter:
+        logger.warning(f"`config.yaml > daemon > interval` should be \
+larger than `kill_program_after` + `jitter` to send all vacancies.")
+
+    while True:
+        start_time = time.monotonic()
+        try:
+            run_session(snapshot, config)
+        # KeyboardInterrupt and SystemExit are not Exception and stop daemon.
+        except Exception as error:
+            logger.exception(f"\n\nSession failed: {error}\n\
+It will be retried in the next session.")
+        sleep_time = max(0, start_time + interval +
+                         random.uniform(-jitter, jitter) - time.monotonic())
+        logger.info(f"\n\nNext session in {sleep_time:.0f} seconds...")
+        time.sleep(sleep_time)
 
 def main():
     """
     Get vacancies in user specified regions, filter them
     and send to Telegram.
     """
+    args = parse_args()
     config = read_config()
-    database = deepcopy(config["database"])
-    areas_table = deepcopy(config["tables"]["areas_table"])
-    try:
-        is_table_exists(database, areas_table)
-    except AssertionError:
-        get_areas(config)
-    config_with_user_areas = search_user_areas(config)
-    write_config(config_with_user_areas)
-    get_vacancies(config_with_user_areas)
-    send_to_telegram(config_with_user_areas)
-
-    print ("\n\nAll tasks done!")
+    setup_logging(config)
+    set_validation_level(
+        config["validation"]["level"], config["validation"]["sample_rate"])
+    snapshot = get_config_snapshot(config)
+    database = snapshot.database
+    areas_table = snapshot.tables.areas_table
+    lock_path = str(Path(database).with_suffix(".lock"))
+    with single_instance_lock(lock_path) as is_locked:
+        if not is_locked:
+            logger.warning(f"\n\nAnother hh_parser session holds `{lock_path}`. \
+Exit to avoid overlapping sessions.")
+            return ()
+        try:
+            is_table_exists(database, areas_table)
+        except AssertionError:
+            get_areas(snapshot)
+        config = load_state(snapshot, config)
+        if args.headless:
+            try:
+                config_with_user_areas = resolve_headless_areas(
+                    snapshot, config, args.areas)
+            except ValueError as error:
+                # One line for cron instead of traceback, exit code 1.
+                logger.error(f"{error}")
+                raise SystemExit(1)
+        else:
+            config_with_user_areas = search_user_areas(snapshot, config)
+        save_state(snapshot, config_with_user_areas)
+        try:
+            if args.daemon:
+                run_daemon(snapshot, config_with_user_areas)
+            else:
+                run_session(snapshot, config_with_user_areas)
+        except KeyboardInterrupt:
+            logger.info("\n\nInterrupted by user.")
+        finally:
+            close_connections()
+
+    logger.info("\n\nAll tasks done!")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3.6
+
+"""
+Durable Telegram outbox: delivery state of every clean vacancy.
+
+States:
+    queued: waits for sending (new or failed attempt which can be retried);
+    in_flight: is being sent right now;
+    sent: delivered, vacancy `is_sent`=1;
+    failed: no attempts left (`config.yaml > telegram_client > max_attempts`).
+State changes are committed by batches. After crash `in_flight` rows
+are the only ones with unknown delivery state, they are queued again.
+"""
+
+import datetime
+
+from logs import count_stage, logger
+from shared import create_table, get_connection, transaction
+import tests.input_tests as in_tests
+import tests.output_tests as out_tests
+
+OUTBOX_STATES = ("queued", "in_flight", "sent", "failed")
+
+def get_current_time():
+    """
+    Get local time for `updated_at` column.
+    """
+    return (datetime.datetime.now().astimezone().replace(
+        microsecond=0, tzinfo=None).isoformat())
+
+def create_outbox_table(database, outbox_table):
+    """
+    Create outbox table if it doesn't exist.
+    """
+    create_table(database, outbox_table, [
+        "vacancy_id INTEGER NOT NULL PRIMARY KEY",
+        "state TEXT NOT NULL",
+        "attempts INT NOT NULL",
+        "updated_at TEXT NOT NULL"
+    ])
+    return ()
+
+def recover_outbox(database, outbox_table):
+    """
+    Queue again messages which were in flight when previous session crashed.
+    They might have been delivered, so their attempt is counted.
+    Return number of recovered messages.
+    """
+    in_tests.test_database_name(database)
+    in_tests.test_table_name(outbox_table)
+
+    query = f"UPDATE {outbox_table} SET state = 'queued', \
+attempts = attempts + 1, updated_at = ? WHERE state = 'in_flight'"
+    with transaction(database) as connection:
+        total_changes = connection.total_changes
+        connection.execute(query, [get_current_time()])
+        recovered = connection.total_changes - total_changes
+    if recovered:
+        logger.warning(f"\n{recovered} messages were in flight when previous session \
+stopped. They are queued again and may be duplicated in Telegram.")
+    return (recovered)
+
+def select_outbox_ids(database, outbox_table, state):
+    """
+    Get set of vacancies ids in `state`.
+    """
+    in_tests.test_database_name(database)
+    in_tests.test_table_name(outbox_table)
+    assert state in OUTBOX_STATES, \
+        f"\n\nExpected state in {OUTBOX_STATES}\nGot {state}"
+
+    connection = get_connection(database)
+    query = f"SELECT vacancy_id FROM {outbox_table} WHERE state = ?"
+    outbox_ids = {row[0] for row in connection.execute(query, [state])}
+    return (outbox_ids)
+
+def mark_in_flight(database, outbox_table, vacancies_ids):
+    """
+    Queue new vacancies and set `in_flight` state to all of them
+    with one commit before sending.
+    """
+    in_tests.test_database_name(database)
+    in_tests.test_table_name(outbox_table)
+    in_tests.test_var_type(vacancies_ids, "vacancies_ids", list)
+
+    current_time = get_current_time()
+    rows = [(vacancy_id, current_time) for vacancy_id in vacancies_ids]
+    with transaction(database) as connection:
+        cursor = connection.cursor()
+        cursor.executemany(f"INSERT OR IGNORE INTO {outbox_table} \
+(vacancy_id, state, attempts, updated_at) VALUES (?, 'queued', 0, ?)", rows)
+        total_changes = connection.total_changes
+        cursor.executemany(f"UPDATE {outbox_table} SET state = 'in_flight', \
+updated_at = ? WHERE vacancy_id = ?", [row[::-1] for row in rows])
+        database_changes = connection.total_changes - total_changes
+        cursor.close()
+    out_tests.test_write_to_database(database_changes, len(rows))
+    return (database_changes)
+
+def finish_outbox_batch(
+        database, outbox_table, vacancies_table, results, max_attempts):
+    """
+    Commit delivery results of one batch:
+    `results` == list of (vacancy_id, state) where state is
+    `sent`, `failed` (attempt failed) or `queued` (wasn't attempted).
+    Sent vacancies get `is_sent`=1 in the same transaction.
+    Failed ones are queued again until `max_attempts`.
+    Return number of sent vacancies.
+    """
+    in_tests.test_database_name(database)
+    in_tests.test_table_name(outbox_table)
+    in_tests.test_table_name(vacancies_table)
+    in_tests.test_var_type(results, "results", list)
+    in_tests.test_var_type(max_attempts, "max_attempts", int)
+
+    current_time = get_current_time()
+    sent_ids = [[vacancy_id] for vacancy_id, state in results
+                if state == "sent"]
+    logger.debug(f"    [{current_time}] Set `is_sent`=1 in {len(sent_ids)} \
+vacancies...")
+    count_stage("telegram", "sent vacancies", len(sent_ids))
+    with transaction(database) as connection:
+        cursor = connection.cursor()
+        total_changes = connection.total_changes
+        cursor.executemany(f"UPDATE {outbox_table} SET \
+state = CASE ?1 \
+WHEN 'sent' THEN 'sent' \
+WHEN 'queued' THEN 'queued' \
+WHEN 'failed' THEN CASE WHEN attempts + 1 >= ?2 THEN 'failed' \
+ELSE 'queued' END END, \
+attempts = attempts + (?1 != 'queued'), \
+updated_at = ?3 WHERE vacancy_id = ?4",
+            [(state, max_attempts, current_time, vacancy_id)
+             for vacancy_id, state in results])
+        outbox_changes = connection.total_changes - total_changes
+        cursor.executemany(
+            f"UPDATE {vacancies_table} SET is_sent = 1 WHERE id = ?",
+            sent_ids)
+        cursor.close()
+    out_tests.test_write_to_database(outbox_changes, len(results))
+    return (len(sent_ids))
@@ -22,5 +22,6 @@ setup(
         "Programming Language :: Python :: 3"
     ],
     python_requires=">=3.6.0",
-    install_requires=["inputimeout", "requests", "ruamel.yaml"]
+    install_requires=["inputimeout", "requests", "ruamel.yaml"],
+    extras_require={"brotli": ["brotli"]}
 )
@@ -4,14 +4,288 @@
 Shared functions for hh_parser.
 """
 
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+import importlib.util
 import json
+import os
+import random
 import sqlite3
 import datetime
+import statistics
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+import requests
 
 from tests.output_tests import test_is_file_exists as is_file_exists
+from logs import count_stage, logger
 import tests.input_tests as in_tests
 import tests.output_tests as out_tests
+from tests.validation import is_validated
+
+# One connection per database per thread. Opened on first use and kept
+# until `close_connections` to avoid connect/commit/close on every statement.
+_local = threading.local()
+
+def get_connection(database):
+    """
+    Get long-lived connection to `database` for current thread.
+    Connection is in autocommit mode, use `transaction` to group statements.
+    """
+    in_tests.test_database_name(database)
+
+    connections = _local.__dict__.setdefault("connections", {})
+    connection = connections.get(database)
+    if connection is None:
+        connection = sqlite3.connect(database, isolation_level=None)
+        # WAL + NORMAL sync: one fsync per checkpoint instead of per commit.
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connections[database] = connection
+    return (connection)
+
+@contextmanager
+def transaction(database):
+    """
+    Run statements inside one transaction and commit them at scope exit.
+    Nested scopes join the outer transaction.
+    """
+    connection = get_connection(database)
+    if connection.in_transaction:
+        yield connection
+        return
+    connection.execute("BEGIN")
+    try:
+        yield connection
+    except BaseException:
+        connection.rollback()
+        raise
+    connection.commit()
+
+def connect_read_only(database):
+    """
+    Open separate read-only connection to `database` for long scans.
+    WAL keeps its snapshot stable while `get_connection` one writes.
+    Caller must close it.
+    """
+    in_tests.test_database_name(database)
+    in_tests.test_is_file_exists(database)
+
+    connection = sqlite3.connect(
+        f"{Path(database).resolve().as_uri()}?mode=ro", uri=True)
+    return (connection)
+
+def close_connections():
+    """
+    Close all connections opened by current thread.
+    """
+    connections = _local.__dict__.setdefault("connections", {})
+    for connection in connections.values():
+        connection.close()
+    connections.clear()
+    return ()
+
+@contextmanager
+def single_instance_lock(lock_path):
+    """
+    Hold exclusive lock on `lock_path` file while in scope.
+    Yield False if another process holds it.
+    """
+    in_tests.test_write_to_file_file_name(lock_path)
+
+    Path(lock_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a+") as f:
+        try:
+            if os.name == "nt":
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield (False)
+            return
+        yield (True)
+        # Lock is released when file is closed.
+
+# Brotli is optional: advertise `br` only if responses can be decoded.
+if importlib.util.find_spec("brotli") is not None:
+    ACCEPT_ENCODING = "gzip, deflate, br"
+else:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+class RateLimiter:
+    """
+    Thread-safe token bucket: `rate` requests per second on average
+    and up to `burst` requests at once.
+    """
+    def __init__(self, rate, burst):
+        in_tests.test_var_type(rate, "rate", (int, float))
+        in_tests.test_var_type(burst, "burst", int)
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return ()
+                sleep_time = (1 - self.tokens) / self.rate
+            time.sleep(sleep_time)
+
+    def pause(self, seconds):
+        """
+        Give no tokens for `seconds` (e.g. server asked to retry later).
+        """
+        in_tests.test_var_type(seconds, "seconds", (int, float))
+        with self.lock:
+            self.tokens = min(self.tokens, 0)
+            self.updated_at = max(
+                self.updated_at, time.monotonic() + seconds)
+
+# One keep-alive HTTP session and rate limiter per process,
+# shared by all modules and threads.
+_http_session = None
+_http_rate_limiter = None
+_http_session_lock = threading.Lock()
+http_latencies = []
+
+# Statuses worth retrying: throttling and transient server errors.
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def get_http_session(snapshot):
+    """
+    Get shared HTTP session with connections pool for hh API calls.
+    `config.yaml > http_client > pool_size` == max kept-alive connections.
+    `snapshot` == `config.ConfigSnapshot`.
+    """
+    global _http_session, _http_rate_limiter
+    headers = snapshot.headers
+    http_client = snapshot.http_client
+    in_tests.test_var_type(headers, "headers", tuple)
+    in_tests.test_var_type(http_client.pool_size, "pool_size", int)
+
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=http_client.pool_size,
+                pool_maxsize=http_client.pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(headers)
+            session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+            _http_rate_limiter = RateLimiter(
+                http_client.rate_limit, http_client.burst)
+            _http_session = session
+    return (_http_session)
+
+def get_retry_delay(response, attempt, backoff):
+    """
+    Get seconds to wait before next attempt.
+    Honor `Retry-After` header (seconds or HTTP date) if server sent it,
+    else use exponential backoff with full jitter.
+    """
+    in_tests.test_var_type(attempt, "attempt", int)
+    in_tests.test_var_type(backoff, "backoff", (int, float))
+
+    retry_after = None
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return (max(0, float(retry_after)))
+        except ValueError:
+            pass
+        try:
+            retry_date = parsedate_to_datetime(retry_after)
+            return (max(0, (retry_date - datetime.datetime.now(
+                datetime.timezone.utc)).total_seconds()))
+        except (TypeError, ValueError):
+            pass
+    return (random.uniform(0, backoff * 2**attempt))
+
+def http_get(snapshot, url, params=None):
+    """
+    GET `url` with shared session, rate limiter and timeouts from
+    `config.yaml > http_client`. Request latency is added to `http_latencies`.
+    Throttled (429), failed (5xx) and timed out requests are retried
+    up to `max_retries` times.
+    `snapshot` == `config.ConfigSnapshot`.
+    """
+    http_client = snapshot.http_client
+    connect_timeout = http_client.connect_timeout
+    read_timeout = http_client.read_timeout
+    max_retries = http_client.max_retries
+    backoff = http_client.backoff
+    in_tests.test_var_type(url, "url", str)
+    in_tests.test_var_type(connect_timeout, "connect_timeout", (int, float))
+    in_tests.test_var_type(read_timeout, "read_timeout", (int, float))
+    in_tests.test_var_type(max_retries, "max_retries", int)
+
+    session = get_http_session(snapshot)
+    for attempt in range(max_retries + 1):
+        _http_rate_limiter.acquire()
+        response = None
+        start_time = time.perf_counter()
+        try:
+            response = session.get(
+                url, params=params, timeout=(connect_timeout, read_timeout))
+        except (requests.ConnectionError, requests.Timeout) as error:
+            if attempt == max_retries:
+                raise
+            logger.warning(f"    GET {url} failed: {error}")
+        latency = time.perf_counter() - start_time
+        http_latencies.append(latency)
+        count_stage("http", "requests")
+        if response is not None:
+            logger.debug(f"    GET {url} -> {response.status_code} \
+in {latency*1000:.0f} ms")
+            if response.status_code not in RETRY_STATUS_CODES or \
+               attempt == max_retries:
+                break
+        retry_delay = get_retry_delay(response, attempt, backoff)
+        count_stage("http", "retries")
+        logger.warning(f"    Retry {attempt + 1}/{max_retries} \
+in {retry_delay:.1f} seconds...")
+        time.sleep(retry_delay)
+    return (response)
+
+def reset_http_latencies():
+    """
+    Clear `http_latencies` before new session, so long-running process
+    reports latencies of the current session only.
+    """
+    http_latencies.clear()
+    return ()
+
+def log_http_latencies():
+    """
+    Log requests number and latency summary of `http_get` calls.
+    """
+    if not http_latencies:
+        return ()
+    logger.info(f"\nHTTP requests: {len(http_latencies)}, \
+first: {http_latencies[0]*1000:.0f} ms, \
+median: {statistics.median(http_latencies)*1000:.0f} ms, \
+max: {max(http_latencies)*1000:.0f} ms")
+    return ()
 
 def write_to_file(file_name, json_data):
     """
@@ -20,12 +294,12 @@ def write_to_file(file_name, json_data):
     """
     in_tests.test_write_to_file_file_name(file_name)
     in_tests.test_var_type(json_data, "json_data", (dict, list))
-    print(f"    Writing json to `{file_name}`...")
+    logger.debug(f"    Writing json to `{file_name}`...")
 
     try:
         Path(file_name).parent.mkdir(parents=True, exist_ok=True)
     except PermissionError:
-        print (f"I don't have permission to create {file_name}.\n\
+        logger.error(f"I don't have permission to create {file_name}.\n\
 Try to change {file_name} var value in `config.yaml` file or just solve this.")
     with open (file_name, "w", encoding="utf8") as f:
         f.write(json.dumps(json_data, indent=4, ensure_ascii=False))
@@ -38,20 +312,18 @@ def create_table(database, table, columns):
     `columns` == list of strings with columns params
     """
     in_tests.test_create_table_columns(database, table, columns)
-    print (f"    Creating table `{table}` at `{database}`...")
+    logger.debug(f"    Creating table `{table}` at `{database}`...")
 
     try:
         Path(database).parent.mkdir(parents=True, exist_ok=True)
     except PermissionError:
-        print (f"I don't have permission to create {database}.\n\
+        logger.error(f"I don't have permission to create {database}.\n\
 Try to change {database} var value in `config.yaml` file or just solve this.")
     query = f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})"
-    connection = sqlite3.connect(database)
-    cursor = connection.cursor()
-    cursor.execute(query)
-    connection.commit()
-    cursor.close()
-    connection.close()
+    with transaction(database) as connection:
+        cursor = connection.cursor()
+        cursor.execute(query)
+        cursor.close()
     out_tests.test_create_table_columns(
         get_table_columns_names(database, table), columns)
     return ()
@@ -62,19 +334,30 @@ def get_table_columns_names(database, table):
     """
     in_tests.test_database_name(database)
     in_tests.test_table_name(table)
-    print (f"    Getting `{database} > {table}` column names...")
+    logger.debug(f"    Getting `{database} > {table}` column names...")
 
-    connection = sqlite3.connect(database)
+    connection = get_connection(database)
     cursor = connection.cursor()
     query = "PRAGMA table_info(" + str(table) + ")"
     columns = list(cursor.execute(query))
     columns_names = [column[1] for column in columns]
 
     cursor.close()
-    connection.close()
     out_tests.test_get_table_columns_names(columns_names)
     return (columns_names)
 
+def get_schema_version(database):
+    """
+    Get database schema version. SQLite increments it on every
+    schema change (new table, new column...).
+    """
+    in_tests.test_database_name(database)
+
+    connection = get_connection(database)
+    schema_version = connection.execute("PRAGMA schema_version").fetchone()[0]
+    out_tests.test_var_type(schema_version, "schema_version", int)
+    return (schema_version)
+
 def create_table_columns(database, table, columns):
     """
     Create columns in table at database.
@@ -82,15 +365,12 @@ def create_table_columns(database, table, columns):
     """
     in_tests.test_create_table_columns(database, table, columns)
 
-    connection = sqlite3.connect(database)
-    cursor = connection.cursor()
-
-    for column in columns:
-        query = f"ALTER TABLE {table} ADD COLUMN {column}"
-        cursor.execute(query)
-    connection.commit()
-    cursor.close()
-    connection.close()
+    with transaction(database) as connection:
+        cursor = connection.cursor()
+        for column in columns:
+            query = f"ALTER TABLE {table} ADD COLUMN {column}"
+            cursor.execute(query)
+        cursor.close()
 
     out_tests.test_create_table_columns(
         get_table_columns_names(database, table), columns)
@@ -102,21 +382,51 @@ def write_to_database(database, table, data):
     `data` == dict of query {key: value}
     """
     in_tests.test_write_to_database_from_dict(database, table, data)
-    print (f"    Insert or update data in `{database} > {table}`...")
+    logger.debug(f"    Insert or update data in `{database} > {table}`...")
 
-    connection = sqlite3.connect(database)
-    cursor = connection.cursor()
     counter = 1
     query_columns = ", ".join(data.keys())
     query_values = f"{'?, ' * len(data)}"[:-2]
     query = \
 f"INSERT OR REPLACE INTO {table} ({query_columns}) VALUES ({query_values});"
-    cursor.execute(query, list(data.values()))
-    connection.commit()
-    database_changes = connection.total_changes
-    cursor.close()
-    connection.close()
+    with transaction(database) as connection:
+        cursor = connection.cursor()
+        total_changes = connection.total_changes
+        cursor.execute(query, list(data.values()))
+        database_changes = connection.total_changes - total_changes
+        cursor.close()
     out_tests.test_write_to_database(database_changes, counter)
+    count_stage("database", f"{table} rows", counter)
+    return (database_changes)
+
+def write_many_to_database(database, table, rows):
+    """
+    Insert or replace many rows in table at database with one `executemany`.
+    `rows` == list of query dicts {key: value}. Missing keys are written as NULL.
+    """
+    in_tests.test_database_name(database)
+    in_tests.test_table_name(table)
+    in_tests.test_var_type(rows, "rows", list)
+    in_tests.test_var_len_more_than(rows, "rows", 0)
+    if is_validated("write_many_to_database"):
+        in_tests.test_write_many_to_database(database, table, rows)
+    logger.debug(f"    Insert or update {len(rows)} rows in `{database} > {table}`...")
+
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    counter = len(rows)
+    query_columns = ", ".join(columns)
+    query_values = f"{'?, ' * len(columns)}"[:-2]
+    query = \
+f"INSERT OR REPLACE INTO {table} ({query_columns}) VALUES ({query_values});"
+    with transaction(database) as connection:
+        cursor = connection.cursor()
+        total_changes = connection.total_changes
+        cursor.executemany(
+            query, ([row.get(column) for column in columns] for row in rows))
+        database_changes = connection.total_changes - total_changes
+        cursor.close()
+    out_tests.test_write_to_database(database_changes, counter)
+    count_stage("database", f"{table} rows", counter)
     return (database_changes)
 
 def is_table_exists(database, table):
@@ -127,39 +437,12 @@ def is_table_exists(database, table):
     in_tests.test_table_name(table)
 
     if is_file_exists(database):
-        connection = sqlite3.connect(database)
+        connection = get_connection(database)
         cursor = connection.cursor()
         query = \
 f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table}'"
         cursor.execute(query)
         is_table_exists = cursor.fetchone()
         cursor.close()
-        connection.close()
         return (is_table_exists)
     return (False)
-
-def set_is_sent_1(database, vacancies_table, vacancy_id):
-    """
-    Change `is_sent` value to 1 in `vacancy_id` row.
-    """
-    in_tests.test_database_name(database)
-    in_tests.test_table_name(vacancies_table)
-    in_tests.test_var_type(vacancy_id, "vacancy_id", int)
-
-    current_time = datetime.datetime.now().astimezone().replace(
-        microsecond=0, tzinfo=None).isoformat()
-    print (
-        f"    [{current_time}] Set `is_sent`=1 in vacancy id={vacancy_id}...")
-
-    connection = sqlite3.connect(database)
-    cursor = connection.cursor()
-    counter = 1
-    query = \
-f"UPDATE {vacancies_table} SET is_sent = 1 WHERE id = {vacancy_id}"
-    cursor.execute(query)
-    connection.commit()
-    database_changes = connection.total_changes
-    cursor.close()
-    connection.close()
-    out_tests.test_write_to_database(database_changes, counter)
-    return (database_changes)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3.6
+
+"""
+Runtime state of hh_parser sessions stored in database,
+so `config.yaml` is read-only.
+
+State keys:
+    date_from: start of the next vacancies search (`url_params > date_from`);
+    areas: user areas filter (`filters > {areas_table}.id`, `url_params > area`);
+    high_water_mark: `published_at` and `id` of the newest stored vacancy.
+"""
+
+import datetime
+import json
+
+from shared import create_table, get_connection, is_table_exists, transaction
+import tests.input_tests as in_tests
+import tests.output_tests as out_tests
+
+STATE_KEYS = ("date_from", "areas", "high_water_mark")
+
+def create_state_table(database, state_table):
+    """
+    Create state table if it doesn't exist.
+    """
+    create_table(database, state_table, [
+        "key TEXT NOT NULL PRIMARY KEY",
+        "value TEXT NOT NULL",
+        "updated_at TEXT NOT NULL"
+    ])
+    return ()
+
+def read_state(database, state_table):
+    """
+    Get saved state: {key: value}. Empty if nothing was saved yet.
+    """
+    in_tests.test_database_name(database)
+    in_tests.test_table_name(state_table)
+
+    if not is_table_exists(database, state_table):
+        return ({})
+    connection = get_connection(database)
+    query = f"SELECT key, value FROM {state_table}"
+    state = {key: json.loads(value)
+             for key, value in connection.execute(query)}
+    out_tests.test_dict_data_type(state)
+    return (state)
+
+def write_state(database, state_table, state):
+    """
+    Write all `state` keys in one transaction.
+    Key with None value and keys which are not in `STATE_KEYS` any more
+    are deleted.
+    """
+    in_tests.test_database_name(database)
+    in_tests.test_table_name(state_table)
+    in_tests.test_var_type(state, "state", dict)
+    for key in state:
+        assert key in STATE_KEYS, \
+            f"\n\nExpected state key in {STATE_KEYS}\nGot {key}"
+
+    create_state_table(database, state_table)
+    current_time = datetime.datetime.now().astimezone().replace(
+        microsecond=0, tzinfo=None).isoformat()
+    with transaction(database) as connection:
+        cursor = connection.cursor()
+        cursor.executemany(f"INSERT OR REPLACE INTO {state_table} \
+(key, value, updated_at) VALUES (?, ?, ?)", [
+            (key, json.dumps(value, ensure_ascii=False), current_time)
+            for key, value in state.items() if value is not None])
+        cursor.executemany(f"DELETE FROM {state_table} WHERE key = ?", [
+            (key,) for key, value in state.items() if value is None])
+        cursor.execute(f"DELETE FROM {state_table} WHERE key NOT IN \
+({', '.join('?' * len(STATE_KEYS))})", STATE_KEYS)
+        cursor.close()
+    return ()
+
+def load_state(snapshot, config):
+    """
+    Apply saved state to config read from `config.yaml`.
+    `config.yaml` values are used until state is saved.
+    """
+    database = snapshot.database
+    state_table = snapshot.state_table
+
+    state = read_state(database, state_table)
+    if "date_from" in state:
+        config["url_params"]["date_from"] = state["date_from"]
+    if "areas" in state:
+        config["filters"]["{areas_table}.id"] = state["areas"]
+        config["url_params"]["area"] = state["areas"]
+    if "high_water_mark" in state:
+        config["high_water_mark"] = state["high_water_mark"]
+    return (config)
+
+def save_state(snapshot, config):
+    """
+    Save runtime state of config to database.
+    """
+    database = snapshot.database
+    state_table = snapshot.state_table
+
+    write_state(database, state_table, {
+        "date_from": config["url_params"].get("date_from"),
+        "areas": list(config["filters"]["{areas_table}.id"]),
+        "high_water_mark": config.get("high_water_mark")
+    })
+    return ()
@@ -8,53 +8,40 @@ https://core.telegram.org/bots
 https://core.telegram.org/bots/api
 """
 
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from operator import itemgetter
 from pathlib import Path
 import datetime
+import hashlib
+import json
 import os
 import re
-import sqlite3
+import threading
 import time
 
+from requests.adapters import HTTPAdapter
 import requests
 
-from config import import_database_columns
-from shared import set_is_sent_1
+from config import select_database_columns
+from logs import count_stage, log_stage_counters, logger
+from outbox import (
+    create_outbox_table,
+    finish_outbox_batch,
+    mark_in_flight,
+    recover_outbox,
+    select_outbox_ids
+)
+from shared import (
+    RETRY_STATUS_CODES,
+    RateLimiter,
+    connect_read_only,
+    get_retry_delay,
+    get_schema_version
+)
 import tests.input_tests as in_tests
 import tests.output_tests as out_tests
-
-def format_inverse_query(query):
-    """
-    Format autogenerated inverse queries to valid ones.
-    """
-    in_tests.test_var_type(query, "query", str)
-    in_tests.test_var_len_more_than(query, "query", 0)
-    # Line order matters!
-    query = query.replace ("== NOT", "!=")
-    query = query.replace ("<> NOT", "==")
-    query = query.replace (">= NOT", "<")
-    query = query.replace ("<= NOT", ">")
-    query = query.replace ("!= NOT", "==")
-    query = query.replace ("= NOT", "!=")
-    query = query.replace ("> NOT", "<=")
-    query = query.replace ("< NOT", ">=")
-    query = query.replace ("NOT BETWEEN NOT", "BETWEEN")
-    query = query.replace ("BETWEEN NOT", "NOT BETWEEN")
-    query = query.replace ("NOT IN NOT", "IN")
-    query = query.replace ("IN NOT", "NOT IN")
-    query = query.replace ("IS NOT NULL NOT", "IS NULL")
-    query = query.replace ("IS NULL NOT", "IS NOT NULL")
-    query = query.replace ("NOT LIKE NOT", "LIKE")
-    query = query.replace ("LIKE NOT", "NOT LIKE")
-    query = query.replace ("NOT EXISTS NOT", "EXISTS")
-    query = query.replace ("EXISTS NOT", "NOT EXISTS")
-    query = query.replace ("NOT REGEXP NOT", "REGEXP")
-    query = query.replace ("REGEXP NOT", "NOT REGEXP")
-    query = query.replace (" NOT NOT", "")
-    query = query.replace ("OR (", "OR ")
-    out_tests.test_var_type(query, "query", str)
-    out_tests.test_var_len_more_than(query, "query", 0)
-    return (query)
+from tests.validation import is_validated
 
 def sanitize_filters_first_keys(user_first_keys):
     """
@@ -80,12 +67,12 @@ def sanitize_filters_columns(key, config_tables, filters_tables):
     user_column = user_table_column.split(".")[1]
 
     assert user_table in filters_tables,\
-        "\n\nTable must be in `config.yaml > filters_tables\n\
+        "\n\nTable must be in `config.yaml > tables`\n\
 Got table: %s" % (user_table)
 
     filters_columns = filters_tables[user_table]
     assert user_column in filters_columns,\
-        "\n\nColumn must be in `config.yaml > filtes_columns > %s\n\
+        "\n\nColumn must be in `database > %s`\n\
 Got column: %s" % (user_table, user_column)
     out_tests.test_table_name(user_table)
     out_tests.test_table_name(user_column)
@@ -127,7 +114,7 @@ def sanitize_filters_pattern(pattern):
         elif isinstance(pattern, (int, float)):
             yield (str(pattern))
         else:
-            print (
+            logger.error(
 f"\n\ntype(pattern) must be in [str, int, float, list]\n\
 Try to edit pattern `{pattern}`\n\n")
             raise TypeError
@@ -138,19 +125,90 @@ Try to edit pattern `{pattern}`\n\n")
     out_tests.test_var_type(splitted_pattern, "splitted_pattern", list)
     return (splitted_pattern)
 
-def format_filters_to_query(filters, config):
+def get_filters_plan_path(database):
+    """
+    Get path of compiled filters plan stored next to database.
+    """
+    in_tests.test_database_name(database)
+    return (str(Path(database).with_suffix(".filters_plan.json")))
+
+def get_filters_plan_key(snapshot, filters):
     """
-    1. Format filters to sql query part.
-    2. Create inverse filters query part to check filtered vacancies.
-    3. Get user patterns.
+    Hash `filters`, `config.yaml > tables` and database schema version:
+    compiled filters plan is valid until one of them changes.
+    Filters are hashed as compiled: ordered keys, operators and string
+    patterns, so filters compiled to the same plan share key
+    (`1`, `"1"` and `[1]`) and different ones don't (`1` and `1.0`).
     """
-    areas_table = deepcopy(config["tables"]["areas_table"])
-    vacancies_table = deepcopy(config["tables"]["vacancies_table"])
-    config_tables = deepcopy(config["tables"])
-    filters_tables = import_database_columns(config)
+    database = snapshot.database
     in_tests.test_format_filters_to_query(filters)
+
+    plan_source = json.dumps({
+        "filters": [[key, value[0], sanitize_filters_pattern(value[1])]
+                    for key, value in filters.items()],
+        "tables": snapshot.tables._asdict(),
+        "schema_version": get_schema_version(database)
+    }, ensure_ascii=False, sort_keys=True)
+    plan_key = hashlib.sha256(plan_source.encode("utf8")).hexdigest()
+    return (plan_key)
+
+def read_filters_plan(plan_path, plan_key):
+    """
+    Get `format_filters_to_query` result from filters plan file.
+    Return None if there is no plan or it was compiled for other key.
+    """
+    try:
+        with open(plan_path, "r", encoding="utf8") as f:
+            plan = json.load(f)
+    except (OSError, ValueError):
+        return (None)
+    if not isinstance(plan, dict) or plan.get("key") != plan_key:
+        return (None)
+    logger.info(f"\nUsing compiled filters from `{plan_path}`")
+    return (plan["query_filters"])
+
+def write_filters_plan(plan_path, plan_key, query_filters, filters_tables):
+    """
+    Write compiled filters: sql parts, patterns and columns whitelist
+    they were checked against. File is replaced atomically.
+    """
+    in_tests.test_write_to_file_file_name(plan_path)
+    logger.debug(f"    Writing compiled filters to `{plan_path}`...")
+
+    temp_path = f"{plan_path}.tmp"
+    with open(temp_path, "w", encoding="utf8") as f:
+        json.dump({
+            "key": plan_key,
+            "query_filters": query_filters,
+            "filters_columns": filters_tables
+        }, f, indent=4, ensure_ascii=False)
+    os.replace(temp_path, plan_path)
+    out_tests.test_is_file_exists(plan_path)
+    return ()
+
+def format_filters_to_query(snapshot, filters):
+    """
+    1. Format direct filters (`{areas_table}.id`, `{vacancies_table}.is_sent`)
+       to sql query part. Only vacancies matched them are filtered.
+    2. Format the rest filters to sql query part which splits vacancies
+       into clean (matched) and dirty (not matched) ones.
+    3. Get user patterns for both parts.
+    """
+    database = snapshot.database
+    areas_table = snapshot.tables.areas_table
+    vacancies_table = snapshot.tables.vacancies_table
+    config_tables = snapshot.tables._asdict()
+    in_tests.test_format_filters_to_query(filters)
+    plan_path = get_filters_plan_path(database)
+    plan_key = get_filters_plan_key(snapshot, filters)
+    query_filters = read_filters_plan(plan_path, plan_key)
+    if query_filters is not None:
+        return (query_filters)
+
+    filters_tables = select_database_columns(snapshot)
+    direct_query_part = ""
     filters_query_part = ""
-    inverse_filters_query_part = ""
+    direct_patterns = []
     patterns = []
     user_first_keys = []
     for key, value in filters.items():
@@ -161,69 +219,94 @@ def format_filters_to_query(filters, config):
         column = sanitize_filters_columns(key, config_tables, filters_tables)
         operator = sanitize_filters_operator(value[0])
         pattern = sanitize_filters_pattern(value[1])
-        patterns += pattern
-        filters_query_part += \
-f"{column} {operator} ({', '.join('?' * len(pattern))}) AND "
-        # We want to keep direct ‘areas_id’ and ‘is_sent’  in inverse_filters
+        query_part = f"{column} {operator} ({', '.join('?' * len(pattern))})"
         if column in [f"{areas_table}.id", f"{vacancies_table}.is_sent"]:
-            inverse_filters_query_part += \
-f"{column} {operator} ({', '.join('?' * len(pattern))}) AND "
+            direct_query_part += f"{query_part} AND "
+            direct_patterns += pattern
         else:
-            inverse_filters_query_part += \
-f"({column} {operator} NOT ({', '.join('?' * len(pattern))}) OR "
+            filters_query_part += f"{query_part} AND "
+            patterns += pattern
+    direct_query_part = direct_query_part[:-len(" AND ")]
     filters_query_part = filters_query_part[:-len(" AND ")]
-    if inverse_filters_query_part.endswith(" OR "):
-        inverse_filters_query_part = \
-format_inverse_query(inverse_filters_query_part[:-len(" OR ")] + ")")
-    if inverse_filters_query_part.endswith(" AND "):
-        inverse_filters_query_part = \
-format_inverse_query(inverse_filters_query_part[:-len(" AND ")])
-    query_filters = [patterns, filters_query_part, inverse_filters_query_part]
+    query_filters = [
+        direct_patterns, direct_query_part, patterns, filters_query_part]
     out_tests.test_format_filters_to_query(filters, query_filters)
+    write_filters_plan(plan_path, plan_key, query_filters, filters_tables)
     return (query_filters)
 
+# SQLite calls `regexp` for every row. Every pattern is compiled only once
+# and its results are cached: vacancies names and areas ids repeat a lot.
+# {pattern: (search, {str(item): result})}
+_regexp_cache = {}
+REGEXP_RESULTS_CACHE_SIZE = 100000
+
+# Rows fetched from filtered vacancies cursor at a time.
+FETCH_BATCH_SIZE = 500
+
 def regexp(expr, item):
+    """
+    SQLite REGEXP function: `item REGEXP expr`.
+    """
     if item is None:
         return False
-    else:
-        reg = re.compile(expr)
-        return reg.search(str(item)) is not None
-
-def filter_vacancies(config, msg_columns, query_filters):
+    # Key results by searched string: 1 and 1.0 are equal dict keys.
+    if type(item) is not str:
+        item = str(item)
+    cached = _regexp_cache.get(expr)
+    if cached is None:
+        cached = _regexp_cache[expr] = (re.compile(expr).search, {})
+    search, results = cached
+    result = results.get(item)
+    if result is None:
+        result = search(item) is not None
+        if len(results) < REGEXP_RESULTS_CACHE_SIZE:
+            results[item] = result
+    return result
+
+def filter_vacancies(
+        snapshot, msg_columns, query_filters, batch_size=FETCH_BATCH_SIZE):
     """
-    Select vacancies which contain and don't contain patterns from `filters` and
-    return them as list of dicts.
+    Select vacancies matched direct filters and split them into
+    ones which contain and don't contain patterns from `filters`
+    in one table scan.
+    Yield `(is_clean, vacancy)` where vacancy is a tuple of `msg_columns`
+    values. Rows are fetched by `batch_size` from separate read-only
+    connection, so `is_sent` can be updated while iterating.
+    Vacancies in `failed` outbox state are skipped: they are never retried.
     """
-    database = deepcopy(config["database"])
-    areas_table = deepcopy(config["tables"]["areas_table"])
-    vacancies_table = deepcopy(config["tables"]["vacancies_table"])
-    patterns = query_filters[0]
-    filters_query_part = query_filters[1]
-    inverse_filters_query_part = query_filters[2]
+    database = snapshot.database
+    areas_table = snapshot.tables.areas_table
+    vacancies_table = snapshot.tables.vacancies_table
+    outbox_table = snapshot.outbox_table
+    direct_patterns, direct_query_part, patterns, filters_query_part = \
+        query_filters
     in_tests.test_filter_vacancies(msg_columns)
-    print ("\n\nFiltering vacancies...")
+    logger.info("\n\nFiltering vacancies...")
 
-    connection = sqlite3.connect(database)
-    cursor = connection.cursor()
+    connection = connect_read_only(database)
     connection.create_function("REGEXP", 2, regexp)
     msg_columns_query = ", ".join(msg_columns)
-    filters_query = f"SELECT {msg_columns_query} FROM \
-{vacancies_table} LEFT JOIN {areas_table} ON {vacancies_table}.area_id == \
-{areas_table}.id WHERE {filters_query_part}"
-    inverse_filters_query =  f"SELECT {msg_columns_query} FROM \
+    # Vacancy is clean if filters are true, NULL and false ones are dirty.
+    filters_query = f"SELECT {msg_columns_query}, \
+CASE WHEN {filters_query_part or 1} THEN 1 ELSE 0 END FROM \
 {vacancies_table} LEFT JOIN {areas_table} ON {vacancies_table}.area_id == \
-{areas_table}.id WHERE {inverse_filters_query_part}"
-    clean_values = cursor.execute(filters_query, patterns)
-    clean_vacancies = [dict(zip(msg_columns, clean_value)) for
-                       clean_value in clean_values]
-    dirty_values = cursor.execute(inverse_filters_query, patterns)
-    dirty_vacancies = [dict(zip(msg_columns, dirty_value)) for
-                       dirty_value in dirty_values]
-    filtered_vacancies = [clean_vacancies, dirty_vacancies]
-    cursor.close()
-    connection.close()
-    out_tests.test_filter_vacancies(filtered_vacancies, msg_columns)
-    return (filtered_vacancies)
+{areas_table}.id WHERE ({direct_query_part or 1}) AND {vacancies_table}.id \
+NOT IN (SELECT vacancy_id FROM {outbox_table} WHERE state = 'failed')"
+    try:
+        cursor = connection.execute(
+            filters_query, patterns + direct_patterns)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                vacancy = row[:-1]
+                if is_validated("filter_vacancies"):
+                    out_tests.test_filtered_vacancy(vacancy, msg_columns)
+                yield (bool(row[-1]), vacancy)
+        cursor.close()
+    finally:
+        connection.close()
 
 def replace_specials_to_underscore(string):
     """
@@ -240,37 +323,52 @@ def replace_specials_to_underscore(string):
     out_tests.test_var_type(new_string, "new_string", str)
     return (new_string)
 
-def write_filtered_vacancies_to_file(
-        vacancies, filtered_path, filters):
+@contextmanager
+def open_filtered_vacancies_file(filtered_path, filters):
     """
-    Format and write filtered vacancies to file.
-    File name == file creation timestamp.
+    Create file for filtered vacancies with `filters` at its
+    beginning and end. File name == file creation timestamp.
     This function is for debugging purpose only.
     """
     timestamp = str(datetime.datetime.now())
     timestamp = replace_specials_to_underscore(timestamp)
     file_name = f"{filtered_path}/{timestamp}.txt".replace("//", "/")
-
     try:
         Path(file_name).parent.mkdir(parents=True, exist_ok=True)
     except PermissionError:
-        print (f"I don't have permission to create {file_name}.\n\
+        logger.error(f"I don't have permission to create {file_name}.\n\
 Try to change {file_name} var value in `config.yaml` file or just solve this.")
 
-    vacancies_counter = 1
     with open(file_name, "w", encoding="utf8") as f:
         f.write(f"FILTERS: {filters}\n\n")
-        for vacancy in vacancies:
-            f.write(f"#{vacancies_counter}\n")
-            for key, value in vacancy.items():
-                f.write (f"{key}: {value}\n")
-            f.write(f"\n\n")
-            vacancies_counter += 1
+        yield (f)
         f.write(f"FILTERS: {filters}\n\n")
 
     out_tests.test_is_file_exists(file_name)
+
+def write_filtered_vacancy(f, vacancies_counter, msg_columns, vacancy):
+    """
+    Write one filtered vacancy to file opened with
+    `open_filtered_vacancies_file`.
+    """
+    f.write(f"#{vacancies_counter}\n")
+    for key, value in zip(msg_columns, vacancy):
+        f.write (f"{key}: {value}\n")
+    f.write(f"\n\n")
     return ()
 
+# Sentence start: first non-space character after [.?!].
+SENTENCE_START_REGEXP = re.compile(r"(?<=[.?!])\s*\S")
+
+def capitalize_sentences(text):
+    """
+    Lower text and capitalize it at 0 position and after [.?!] characters
+    with one regex pass.
+    """
+    text = SENTENCE_START_REGEXP.sub(
+        lambda match: match.group().title(), text.lower())
+    return (text[:1].title() + text[1:])
+
 def format_msg_values(data):
     """
     1. Capitalize at 0 position and after [.?!] characters
@@ -280,13 +378,7 @@ def format_msg_values(data):
     in_tests.test_var_type(data, "data", (str, int, float, type(None)))
 
     if isinstance(data, str):
-        sentences = re.findall(r".*?(?:\.|\?|!|$)\s*", data)
-        if sentences == []:
-            formated_data = data.capitalize()
-        else:
-            formated_data = ""
-            for sentence in sentences:
-                formated_data += sentence.capitalize()
+        formated_data = capitalize_sentences(data)
     elif isinstance(data, type(None)):
         formated_data = ""
     else:
@@ -294,56 +386,80 @@ def format_msg_values(data):
     out_tests.test_var_type(formated_data, "formated_data", (str, int, float))
     return (formated_data)
 
-def build_msg(vacancy, config):
+RENDERER_CACHE_SIZE = 100000
+
+def compile_msg_renderer(snapshot, msg_columns):
     """
-    Build html of one vacancy.
+    Compile message template for vacancies rows once per run.
+    Return function which builds html of one vacancy
+    from tuple of `msg_columns` values.
     """
-    areas_table = deepcopy(config["tables"]["areas_table"])
-    vacancies_table = deepcopy(config["tables"]["vacancies_table"])
-    income_tax = deepcopy(config["income_tax"])
+    areas_table = snapshot.tables.areas_table
+    vacancies_table = snapshot.tables.vacancies_table
+    income_tax = snapshot.income_tax
     in_tests.test_var_type(income_tax, "income_tax", (int, float))
+    in_tests.test_filter_vacancies(msg_columns)
 
-    title = \
-format_msg_values(vacancy[f"{vacancies_table}.name"])
-    alternate_url = \
-vacancy[f"{vacancies_table}.alternate_url"]
-    salary_from = \
-format_msg_values(vacancy[f"{vacancies_table}.salary_from"])
-    salary_to = \
-format_msg_values(vacancy[f"{vacancies_table}.salary_to"])
-    salary_currency = \
-format_msg_values(vacancy[f"{vacancies_table}.salary_currency"])
-    is_before_tax = \
-vacancy[f"{vacancies_table}.salary_gross"]
-    requirement = \
-format_msg_values(vacancy[f"{vacancies_table}.snippet_requirement"])
-    responsibility = \
-format_msg_values(vacancy[f"{vacancies_table}.snippet_responsibility"])
-    schedule = \
-format_msg_values(vacancy[f"{vacancies_table}.schedule_name"])
-    working_time_intervals = \
-format_msg_values(vacancy[f"{vacancies_table}.working_time_intervals_name"])
-    working_time_modes = \
-format_msg_values(vacancy[f"{vacancies_table}.working_time_modes_name"])
-    city = \
-format_msg_values(vacancy[f"{areas_table}.name"])
-    address = \
-format_msg_values(vacancy[f"{vacancies_table}.address_raw"])
-    created = \
-vacancy[f"{vacancies_table}.created_at"]
-
-    if salary_from and salary_to and salary_from > salary_to:
-        salary_from, salary_to = salary_to, salary_from
-    if salary_currency:
-        salary_currency = salary_currency.upper()
-    if is_before_tax and salary_from:
-        salary_from = int(salary_from - salary_from * income_tax)
-    if is_before_tax and salary_to:
-        salary_to = int(salary_to - salary_to * income_tax)
-    if address:
-        city = ""
-
-    msg = f"<a href='{alternate_url}'>{title}</a>\n\
+    columns_indexes = {column: index for index, column in
+                       enumerate(msg_columns)}
+    get_values = itemgetter(*[columns_indexes[column] for column in [
+        f"{vacancies_table}.name",
+        f"{vacancies_table}.alternate_url",
+        f"{vacancies_table}.salary_from",
+        f"{vacancies_table}.salary_to",
+        f"{vacancies_table}.salary_currency",
+        f"{vacancies_table}.salary_gross",
+        f"{vacancies_table}.snippet_requirement",
+        f"{vacancies_table}.snippet_responsibility",
+        f"{vacancies_table}.schedule_name",
+        f"{vacancies_table}.working_time_intervals_name",
+        f"{vacancies_table}.working_time_modes_name",
+        f"{areas_table}.name",
+        f"{vacancies_table}.address_raw",
+        f"{vacancies_table}.created_at"
+    ]])
+    # Schedules, currencies, cities etc. repeat a lot: format them once.
+    formated_values = {}
+
+    def format_value(data):
+        if data is None:
+            return ("")
+        if type(data) is not str:
+            return (data)
+        formated_data = formated_values.get(data)
+        if formated_data is None:
+            formated_data = capitalize_sentences(data)
+            if len(formated_values) < RENDERER_CACHE_SIZE:
+                formated_values[data] = formated_data
+        return (formated_data)
+
+    def render_msg(vacancy):
+        (title, alternate_url, salary_from, salary_to, salary_currency,
+         is_before_tax, requirement, responsibility, schedule,
+         working_time_intervals, working_time_modes, city, address,
+         created) = get_values(vacancy)
+        title = format_value(title)
+        salary_from = format_value(salary_from)
+        salary_to = format_value(salary_to)
+        salary_currency = format_value(salary_currency)
+        requirement = format_value(requirement)
+        responsibility = format_value(responsibility)
+        schedule = format_value(schedule)
+        working_time_intervals = format_value(working_time_intervals)
+        working_time_modes = format_value(working_time_modes)
+        address = format_value(address)
+        city = "" if address else format_value(city)
+
+        if salary_from and salary_to and salary_from > salary_to:
+            salary_from, salary_to = salary_to, salary_from
+        if salary_currency:
+            salary_currency = salary_currency.upper()
+        if is_before_tax and salary_from:
+            salary_from = int(salary_from - salary_from * income_tax)
+        if is_before_tax and salary_to:
+            salary_to = int(salary_to - salary_to * income_tax)
+
+        msg = f"<a href='{alternate_url}'>{title}</a>\n\
 <em>{salary_from} - {salary_to} {salary_currency}</em>\n\n\
 {responsibility}\n\n\
 {requirement}\n\n\
@@ -351,27 +467,230 @@ vacancy[f"{vacancies_table}.created_at"]
 {city}, {address}\n\n\
 <em>Добавлено: {created}</em>"
 
-    msg = msg.replace(", ,", ", ")
-    msg = msg.replace("  ", " ")
-    msg = msg.replace(" \n", "\n")
-    msg = msg.replace(",\n", "\n")
-    msg = msg.replace("\n,", "\n")
-    msg = msg.replace("\n ", "\n")
-
-    out_tests.test_var_type(msg, "message", str)
-    out_tests.test_var_len_more_than(msg, "message", 149)
-    return (msg)
-
-def send_to_telegram(config):
-    database = deepcopy(config["database"])
-    areas_table = deepcopy(config["tables"]["areas_table"])
-    vacancies_table = deepcopy(config["tables"]["vacancies_table"])
-    chat_id = deepcopy(config["chat_id"])
-    clean_path = deepcopy(config["clean_vacancies_file_path"])
-    dirty_path = deepcopy(config["dirty_vacancies_file_path"])
+        msg = msg.replace(", ,", ", ")
+        msg = msg.replace("  ", " ")
+        msg = msg.replace(" \n", "\n")
+        msg = msg.replace(",\n", "\n")
+        msg = msg.replace("\n,", "\n")
+        msg = msg.replace("\n ", "\n")
+
+        if is_validated("render_msg"):
+            out_tests.test_var_len_more_than(msg, "message", 149)
+        return (msg)
+
+    return (render_msg)
+
+# One keep-alive session and rate limiters for Telegram bot API per process:
+# all chats limiter and one chat limiter (all messages go to `chat_id`).
+_telegram_session = None
+_telegram_rate_limiter = None
+_telegram_chat_rate_limiter = None
+_telegram_session_lock = threading.Lock()
+
+def get_telegram_session(snapshot):
+    """
+    Get shared HTTP session with connections pool for Telegram calls.
+    `config.yaml > telegram_client > pool_size` == max kept-alive connections.
+    """
+    global _telegram_session, _telegram_rate_limiter, \
+        _telegram_chat_rate_limiter
+    telegram_client = snapshot.telegram_client
+    in_tests.test_var_type(telegram_client.pool_size, "pool_size", int)
+
+    with _telegram_session_lock:
+        if _telegram_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=telegram_client.pool_size,
+                pool_maxsize=telegram_client.pool_size)
+            session.mount("https://", adapter)
+            _telegram_rate_limiter = RateLimiter(
+                telegram_client.rate_limit, telegram_client.burst)
+            _telegram_chat_rate_limiter = RateLimiter(
+                telegram_client.chat_rate_limit, telegram_client.chat_burst)
+            _telegram_session = session
+    return (_telegram_session)
+
+def get_telegram_retry_after(response):
+    """
+    Get `parameters.retry_after` seconds from Telegram error response.
+    Return None if there is no one.
+    """
+    try:
+        retry_after = response.json()["parameters"]["retry_after"]
+    except (ValueError, KeyError, TypeError):
+        return (None)
+    if not isinstance(retry_after, (int, float)):
+        return (None)
+    return (retry_after)
+
+def post_telegram_message(snapshot, token, msg_params, stop_time):
+    """
+    POST one message with shared session and rate limiters.
+    Throttled (429) requests wait `retry_after` seconds, failed (5xx)
+    and timed out ones are retried with backoff up to `max_retries` times.
+    Return outbox state: `sent`, `failed` or `queued` if message
+    wasn't attempted or was cut off by `stop_time`.
+    """
+    telegram_client = snapshot.telegram_client
+    connect_timeout = telegram_client.connect_timeout
+    read_timeout = telegram_client.read_timeout
+    max_retries = telegram_client.max_retries
+    backoff = telegram_client.backoff
+    in_tests.test_var_type(msg_params, "msg_params", dict)
+
+    session = get_telegram_session(snapshot)
+    url = f"https://api.telegram.org/bot{token}/sendMessage"
+    for attempt in range(max_retries + 1):
+        _telegram_rate_limiter.acquire()
+        _telegram_chat_rate_limiter.acquire()
+        # Retries cut off by session end are not failed attempts.
+        if datetime.datetime.now() > stop_time:
+            return ("queued")
+        response = None
+        try:
+            response = session.post(
+                url, json=msg_params, timeout=(connect_timeout, read_timeout))
+        except (requests.ConnectionError, requests.Timeout) as error:
+            logger.warning(f"    Telegram sendMessage failed: {error}")
+        if response is not None:
+            if response.status_code == 200:
+                count_stage("telegram", "sent messages")
+                return ("sent")
+            retry_after = None
+            if response.status_code == 429:
+                retry_after = get_telegram_retry_after(response)
+            elif response.status_code not in RETRY_STATUS_CODES:
+                logger.warning(f"    Telegram sendMessage -> {response.status_code}: \
+{response.text}")
+                count_stage("telegram", "failed messages")
+                return ("failed")
+            if retry_after is not None:
+                logger.warning(f"\n\nPhew, I was toooo fast. \
+Need a rest for {retry_after} seconds...")
+                count_stage("telegram", "throttled")
+                # Throttling is per bot: hold all messages in flight.
+                _telegram_rate_limiter.pause(retry_after)
+                continue
+        if attempt == max_retries:
+            break
+        retry_delay = get_retry_delay(response, attempt, backoff)
+        count_stage("telegram", "retries")
+        logger.warning(f"    Retry {attempt + 1}/{max_retries} \
+in {retry_delay:.1f} seconds...")
+        time.sleep(retry_delay)
+    count_stage("telegram", "failed messages")
+    return ("failed")
+
+# Telegram message text limit and separator of vacancies in digest.
+MAX_MSG_LENGTH = 4096
+DIGEST_SEPARATOR = "\n\n\u2014\u2014\u2014\n\n"
+
+def cut_msg(msg, max_length=MAX_MSG_LENGTH):
+    """
+    Cut message longer than `max_length` by whole lines.
+    `render_msg` tags never span lines, so html of cut message stays valid.
+    """
+    in_tests.test_var_type(msg, "msg", str)
+    if len(msg) <= max_length:
+        return (msg)
+
+    cut_lines = []
+    length = len("\n...")
+    for line in msg.split("\n"):
+        length += len(line) + 1
+        if length > max_length:
+            break
+        cut_lines.append(line)
+    cut_msg = "\n".join(cut_lines) + "\n..."
+    out_tests.test_var_len_more_than(cut_msg, "cut_msg", 0)
+    return (cut_msg)
+
+def flush_digest(digest):
+    """
+    Empty `digest` == [vacancies_ids, msgs, length] and
+    return its content as `(vacancies_ids, msgs)`.
+    """
+    packed = (digest[0], digest[1])
+    digest[:] = [[], [], 0]
+    return (packed)
+
+def pack_digest(digest, vacancy_id, msg, max_length=MAX_MSG_LENGTH):
+    """
+    Add vacancy message to `digest` == [vacancies_ids, msgs, length].
+    Messages are never split between digests. If message doesn't fit
+    `max_length`, return flushed digest `(vacancies_ids, msgs)`
+    before adding it, else return None.
+    """
+    in_tests.test_var_type(msg, "msg", str)
+
+    packed = None
+    length = len(msg)
+    if digest[1]:
+        length += digest[2] + len(DIGEST_SEPARATOR)
+    if digest[1] and length > max_length:
+        packed = flush_digest(digest)
+        length = len(msg)
+    digest[0].append(vacancy_id)
+    digest[1].append(msg)
+    digest[2] = length
+    return (packed)
+
+def send_outbox_batch(
+        snapshot, executor, token, msg_params, batch, stop_time):
+    """
+    Send batch of `(vacancies_ids, msgs)` through outbox: commit `in_flight`
+    state, send messages in parallel and commit their results.
+    Messages of one item are sent as one digest. If digest fails, its
+    vacancies are sent one by one, so only the bad ones count attempts.
+    Return number of sent vacancies.
+    """
+    database = snapshot.database
+    vacancies_table = snapshot.tables.vacancies_table
+    outbox_table = snapshot.outbox_table
+    max_attempts = snapshot.telegram_client.max_attempts
+    in_tests.test_var_type(batch, "batch", list)
+
+    mark_in_flight(database, outbox_table, [
+        vacancy_id for vacancies_ids, msgs in batch
+        for vacancy_id in vacancies_ids])
+    sending = [(vacancies_ids, msgs, executor.submit(
+        post_telegram_message, snapshot, token,
+        dict(msg_params, text=DIGEST_SEPARATOR.join(msgs)), stop_time))
+               for vacancies_ids, msgs in batch]
+    results = []
+    resending = []
+    for vacancies_ids, msgs, future in sending:
+        state = future.result()
+        if state == "failed" and len(vacancies_ids) > 1:
+            count_stage("telegram", "split digests")
+            resending.extend(zip(vacancies_ids, [executor.submit(
+                post_telegram_message, snapshot, token,
+                dict(msg_params, text=msg), stop_time) for msg in msgs]))
+            continue
+        results.extend(
+            (vacancy_id, state) for vacancy_id in vacancies_ids)
+    results.extend(
+        (vacancy_id, future.result()) for vacancy_id, future in resending)
+    sent_number = finish_outbox_batch(
+        database, outbox_table, vacancies_table, results, max_attempts)
+    return (sent_number)
+
+def send_to_telegram(snapshot, config):
+    database = snapshot.database
+    areas_table = snapshot.tables.areas_table
+    vacancies_table = snapshot.tables.vacancies_table
+    chat_id = snapshot.chat_id
+    clean_path = snapshot.clean_vacancies_file_path
+    dirty_path = snapshot.dirty_vacancies_file_path
     token = os.environ["hh_bot_token"]
-    filters = deepcopy(config["filters"])
-    kill_program_after = deepcopy(config["kill_program_after"])
+    filters = config["filters"]
+    kill_program_after = snapshot.kill_program_after
+    outbox_table = snapshot.outbox_table
+    digest_mode = snapshot.digest
+    concurrency = snapshot.telegram_client.concurrency
+    outbox_batch_size = snapshot.telegram_client.outbox_batch_size
+    max_attempts = snapshot.telegram_client.max_attempts
     in_tests.test_database_name(database)
     in_tests.test_table_name(areas_table)
     in_tests.test_table_name(vacancies_table)
@@ -381,6 +700,11 @@ def send_to_telegram(config):
     in_tests.test_var_type(token, "token", str)
     in_tests.test_var_len_more_than(token, "token", 0)
     in_tests.test_var_type(kill_program_after, "token", int)
+    in_tests.test_table_name(outbox_table)
+    in_tests.test_var_type(digest_mode, "digest", bool)
+    in_tests.test_var_type(concurrency, "concurrency", int)
+    in_tests.test_var_type(outbox_batch_size, "outbox_batch_size", int)
+    in_tests.test_var_type(max_attempts, "max_attempts", int)
 
     msg_columns = [
         f"{vacancies_table}.id",
@@ -406,50 +730,74 @@ def send_to_telegram(config):
         "parse_mode": "HTML"
         }
 
-    query_filters = format_filters_to_query(
-        filters, config)
-    clean_vacancies, dirty_vacancies = filter_vacancies(
-        config, msg_columns, query_filters)
-    for vacancies, filtered_path in zip(
-            [clean_vacancies, dirty_vacancies], [clean_path, dirty_path]):
-        write_filtered_vacancies_to_file(
-            vacancies, filtered_path, filters)
+    create_outbox_table(database, outbox_table)
+    query_filters = format_filters_to_query(snapshot, filters)
+    recover_outbox(database, outbox_table)
+    failed_number = len(select_outbox_ids(database, outbox_table, "failed"))
+    render_msg = compile_msg_renderer(snapshot, msg_columns)
+    vacancy_id_index = msg_columns.index(f"{vacancies_table}.id")
 
-    print ("\n\nSending to Telegram... \n\
+    logger.info("\n\nSending to Telegram... \n\
 [You may recieve more vacancies than were got in current session\n\
 if sending had failed during previous sessions.]\n")
-    print (f"\nTotal messages to send: {len(clean_vacancies)}")
-    print (f"Program will auto-terminate in {kill_program_after} seconds to \
+    logger.info(f"Program will auto-terminate in {kill_program_after} seconds to \
 avoid overlapping with scheduled starts.\n\
 It is highly recommended to set schedule interval to be larger than \
 `config.yaml > kill_program_after` one.\n")
     sent_counter = 0
+    clean_counter = 0
+    dirty_counter = 0
+    is_time_over = False
     stop_time = datetime.datetime.now() + datetime.timedelta(
         seconds=kill_program_after)
-    for clean_vacancy in clean_vacancies:
-        if datetime.datetime.now() > stop_time:
-            break
-        vacancy_id = clean_vacancy[f"{vacancies_table}.id"]
-        msg = build_msg(clean_vacancy, config)
-        msg_params["text"] = msg
-        while True:
-            try:
-                if datetime.datetime.now() > stop_time:
-                    break
-                response = requests.get(
-                    f"https://api.telegram.org/bot{token}/sendMessage", \
-                    params=msg_params)
-                out_tests.test_is_status_code_200(response)
-                set_is_sent_1(database, vacancies_table, vacancy_id)
-                sent_counter += 1
-                break
-            except AssertionError:
-                sleep_time = 60
-                print (
-        f"\n\nPhew, I was toooo fast. Need a rest for {sleep_time} seconds...")
-                time.sleep(sleep_time)
+    batch = []
+    digest = [[], [], 0]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, \
+         open_filtered_vacancies_file(clean_path, filters) as clean_file, \
+         open_filtered_vacancies_file(dirty_path, filters) as dirty_file:
+        for is_clean, vacancy in filter_vacancies(
+                snapshot, msg_columns, query_filters):
+            if not is_clean:
+                dirty_counter += 1
+                write_filtered_vacancy(
+                    dirty_file, dirty_counter, msg_columns, vacancy)
+                continue
+            clean_counter += 1
+            write_filtered_vacancy(
+                clean_file, clean_counter, msg_columns, vacancy)
+            # Keep scanning after timeout to finish filtered files.
+            if is_time_over or datetime.datetime.now() > stop_time:
+                is_time_over = True
                 continue
-    print (f"\n\nSent {sent_counter} vacancies.")
-    print (f"{len(clean_vacancies)-sent_counter} unsent vacancies \
-will be processed in next sessions.")
+            vacancy_id = vacancy[vacancy_id_index]
+            msg = cut_msg(render_msg(vacancy))
+            if digest_mode:
+                packed = pack_digest(digest, vacancy_id, msg)
+                if packed is None:
+                    continue
+            else:
+                packed = ([vacancy_id], [msg])
+            batch.append(packed)
+            if len(batch) >= outbox_batch_size:
+                sent_counter += send_outbox_batch(
+                    snapshot, executor, token, msg_params, batch, stop_time)
+                batch = []
+        if digest[0] and not is_time_over:
+            batch.append(flush_digest(digest))
+        if batch:
+            sent_counter += send_outbox_batch(
+                snapshot, executor, token, msg_params, batch, stop_time)
+    logger.info(f"\n\nFiltered {clean_counter} clean and {dirty_counter} dirty \
+vacancies.")
+    new_failed_number = len(select_outbox_ids(
+        database, outbox_table, "failed")) - failed_number
+    logger.info(f"Sent {sent_counter} vacancies.")
+    if new_failed_number:
+        logger.warning(f"{new_failed_number} vacancies failed \
+{max_attempts} times and will not be retried.")
+    logger.info(f"{clean_counter-sent_counter-new_failed_number} unsent \
+vacancies will be processed in next sessions.")
+    log_stage_counters("telegram")
+    log_stage_counters("database")
     return ()
@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for hh_parser.
+Run from project root: `python -m tests.benchmarks`
+"""
+
+from copy import deepcopy
+from pathlib import Path
+import re
+import sqlite3
+import tempfile
+import time
+
+from config import Tables, get_config_snapshot, read_config
+import outbox
+import shared
+import telegram
+from tests.validation import set_validation_level
+import vacancies
+
+BENCHMARK_TABLES = {
+    "areas_table": "areas",
+    "vacancies_table": "vacancies",
+    "streets_table": "streets",
+    "metro_stations_table": "metro_stations",
+    "employers_table": "employers",
+    "vacancies_metro_stations_table": "vacancies_metro_stations"
+}
+
+def create_benchmark_config(database):
+    """
+    Create minimal config for benchmarks database.
+    """
+    return ({
+        "database": database,
+        "tables": dict(BENCHMARK_TABLES),
+        "income_tax": 0.13
+    })
+
+def create_benchmark_snapshot(database):
+    """
+    Create config snapshot for benchmarks database.
+    """
+    return (get_config_snapshot(read_config())._replace(
+        database=database, tables=Tables(**BENCHMARK_TABLES)))
+
+def create_fake_vacancy(number):
+    """
+    Create hh-like vacancy item (see `load_vacancies` response `items`).
+    """
+    return ({
+        "id": str(1000000 + number),
+        "premium": False,
+        "name": f"Python Developer {number}",
+        "department": None,
+        "has_test": False,
+        "response_letter_required": False,
+        "area": {"id": "1", "name": "Москва",
+                 "url": "https://api.hh.ru/areas/1"},
+        "salary": {"from": 100000 + number, "to": None, "currency": "RUR",
+                   "gross": True},
+        "type": {"id": "open", "name": "Открытая"},
+        "address": {
+            "city": "Москва",
+            "street": f"улица {number % 50}",
+            "building": "1",
+            "description": None,
+            "lat": 55.7,
+            "lng": 37.6,
+            "raw": f"Москва, улица {number % 50}, 1",
+            "metro": {"station_name": "Арбатская", "line_name": "Филёвская",
+                      "station_id": "4.2", "line_id": "4",
+                      "lat": 55.75, "lng": 37.6},
+            "metro_stations": [
+                {"station_name": "Арбатская", "line_name": "Филёвская",
+                 "station_id": "4.2", "line_id": "4",
+                 "lat": 55.75, "lng": 37.6}],
+            "id": str(5000 + number)
+        },
+        "response_url": None,
+        "sort_point_distance": None,
+        "published_at": f"2021-08-30T18:{number % 60:02d}:00+0300",
+        "created_at": f"2021-08-30T18:{number % 60:02d}:00+0300",
+        "archived": False,
+        "apply_alternate_url":
+            "https://hh.ru/applicant/vacancy_response?vacancyId=1",
+        "insider_interview": None,
+        "url": f"https://api.hh.ru/vacancies/{number}",
+        "alternate_url": f"https://hh.ru/vacancy/{number}",
+        "relations": [],
+        "employer": {
+            "id": str(number % 300 + 1),
+            "name": f"Employer {number % 300}",
+            "url": "https://api.hh.ru/employers/1",
+            "alternate_url": "https://hh.ru/employer/1",
+            "logo_urls": {"original": "https://hh.ru/o.png",
+                          "240": "https://hh.ru/240.png",
+                          "90": "https://hh.ru/90.png"},
+            "vacancies_url": "https://api.hh.ru/vacancies?employer_id=1",
+            "trusted": True
+        },
+        "snippet": {
+            "requirement": "Опыт работы с Python. знание sql.",
+            "responsibility": "разработка бэкенда. поддержка."
+        },
+        "contacts": None,
+        "schedule": {"id": "fullDay", "name": "Полный день"},
+        "working_days": [],
+        "working_time_intervals": [],
+        "working_time_modes": [],
+        "accept_temporary": False
+    })
+
+def create_benchmark_areas_table(database):
+    """
+    Create areas table with the only area of fake vacancies.
+    """
+    shared.create_table(database, BENCHMARK_TABLES["areas_table"], [
+        "id INT NOT NULL PRIMARY KEY",
+        "parent_id INT",
+        "name TEXT NOT NULL"
+    ])
+    shared.write_to_database(database, BENCHMARK_TABLES["areas_table"], {
+        "id": 1,
+        "parent_id": 113,
+        "name": "москва"
+    })
+    return ()
+
+def benchmark_write_to_database(rows_number=2000):
+    """
+    Measure ingest throughput of row-by-row `write_to_database`.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database = str(Path(temp_dir) / "benchmark.db")
+        table = "benchmark"
+        shared.create_table(database, table, [
+            "id INTEGER NOT NULL PRIMARY KEY",
+            "name TEXT",
+            "salary_from INT",
+            "is_sent INT NOT NULL"
+        ])
+        start_time = time.perf_counter()
+        for row_id in range(rows_number):
+            shared.write_to_database(database, table, {
+                "id": row_id,
+                "name": f"vacancy {row_id}",
+                "salary_from": row_id * 10,
+                "is_sent": 0
+            })
+        elapsed = time.perf_counter() - start_time
+        shared.close_connections()
+    print (f"write_to_database: {rows_number} rows in {elapsed:.3f} s \
+({rows_number/elapsed:.0f} rows/s)")
+    return (elapsed)
+
+def benchmark_write_vacancies_to_database(pages_number=10, per_page=100):
+    """
+    Measure ingest throughput of hh pages with `write_vacancies_to_database`.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database = str(Path(temp_dir) / "benchmark.db")
+        snapshot = create_benchmark_snapshot(database)
+        create_benchmark_areas_table(database)
+        pages = [[create_fake_vacancy(page * per_page + number)
+                  for number in range(per_page)]
+                 for page in range(pages_number)]
+        start_time = time.perf_counter()
+        for items in pages:
+            vacancies.write_vacancies_to_database(snapshot, items, {1})
+        elapsed = time.perf_counter() - start_time
+        shared.close_connections()
+    print (f"write_vacancies_to_database: {pages_number} pages in \
+{elapsed:.3f} s ({elapsed/pages_number*1000:.1f} ms/page)")
+    return (elapsed)
+
+def create_legacy_vacancies_generator(items, parent_key=""):
+    """
+    Key/value generator which was used to flatten vacancies
+    before `flatten_vacancy`. Kept as benchmark reference.
+    """
+    if isinstance(items, dict):
+        for key, value in items.items():
+            if isinstance(value, (dict, list)):
+                yield from create_legacy_vacancies_generator(
+                    value, parent_key+key+"_")
+            else:
+                yield (parent_key+key, value)
+    elif isinstance(items, list):
+        for item in items:
+            yield from create_legacy_vacancies_generator(item, parent_key)
+
+def flatten_legacy_vacancies(items):
+    """
+    Rebuild vacancies from key/value generator by spotting the next `id` key
+    as `write_vacancies_to_database` did before `flatten_vacancy`.
+    """
+    skip_keys = list(vacancies.VACANCY_SKIP_KEYS)
+    flat_vacancies = []
+    vacancy = {}
+    tables_cache = {}
+    for key, value in create_legacy_vacancies_generator(items):
+        try:
+            value = value.lower()
+        except AttributeError:
+            pass
+        if key != "id" or vacancy == {}:
+            tables_cache[key] = value
+            if key not in skip_keys and value != None:
+                vacancy[key] = value
+        else:
+            flat_vacancies.append((vacancy, tables_cache))
+            vacancy = {key: value}
+            tables_cache = {key: value}
+    flat_vacancies.append((vacancy, tables_cache))
+    return (flat_vacancies)
+
+def benchmark_flatten_vacancies(vacancies_number=10000):
+    """
+    Compare legacy key/value generator with `flatten_vacancy`.
+    """
+    items = [create_fake_vacancy(number) for number in range(vacancies_number)]
+
+    start_time = time.perf_counter()
+    flatten_legacy_vacancies(items)
+    legacy_elapsed = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for item in items:
+        vacancies.create_vacancy_records(vacancies.flatten_vacancy(item))
+    elapsed = time.perf_counter() - start_time
+    print (f"flatten {vacancies_number} vacancies: \
+legacy generator {legacy_elapsed:.3f} s, flatten_vacancy {elapsed:.3f} s")
+    return (legacy_elapsed, elapsed)
+
+def legacy_regexp(expr, item):
+    """
+    SQLite REGEXP function which was used before patterns cache.
+    Kept as benchmark reference.
+    """
+    if item is None:
+        return False
+    else:
+        reg = re.compile(expr)
+        return reg.search(str(item)) is not None
+
+def benchmark_regexp(rows_number=50000, names_number=5000):
+    """
+    Compare per-row cost of legacy and cached SQLite REGEXP functions
+    with `config.yaml > filters > {vacancies_table}.name` pattern.
+    Vacancies names repeat: `names_number` distinct ones.
+    """
+    pattern = read_config()["filters"]["{vacancies_table}.name"][1]
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE vacancies (name TEXT)")
+    connection.executemany("INSERT INTO vacancies VALUES (?)", (
+        (f"менеджер по работе с клиентами {number % names_number}",)
+        for number in range(rows_number)))
+    query = "SELECT count(*) FROM vacancies WHERE name NOT REGEXP ?"
+
+    elapsed = []
+    for function in [legacy_regexp, telegram.regexp]:
+        connection.create_function("REGEXP", 2, function)
+        start_time = time.perf_counter()
+        connection.execute(query, [pattern]).fetchone()
+        elapsed.append(time.perf_counter() - start_time)
+    connection.close()
+    print (f"REGEXP on {rows_number} rows: \
+legacy {elapsed[0]/rows_number*1e6:.2f} us/row, \
+cached {elapsed[1]/rows_number*1e6:.2f} us/row")
+    return (elapsed)
+
+def legacy_format_msg_values(data):
+    """
+    `format_msg_values` which was used before `capitalize_sentences`.
+    Kept as benchmark reference.
+    """
+    if isinstance(data, str):
+        sentences = re.findall(r".*?(?:\.|\?|!|$)\s*", data)
+        if sentences == []:
+            return (data.capitalize())
+        return ("".join(sentence.capitalize() for sentence in sentences))
+    if data is None:
+        return ("")
+    return (data)
+
+def legacy_build_msg(vacancy, config):
+    """
+    `build_msg` which was used before `compile_msg_renderer`.
+    Kept as benchmark reference.
+    """
+    areas_table = deepcopy(config["tables"]["areas_table"])
+    vacancies_table = deepcopy(config["tables"]["vacancies_table"])
+    income_tax = deepcopy(config["income_tax"])
+    title = legacy_format_msg_values(vacancy[f"{vacancies_table}.name"])
+    alternate_url = vacancy[f"{vacancies_table}.alternate_url"]
+    salary_from = legacy_format_msg_values(
+        vacancy[f"{vacancies_table}.salary_from"])
+    salary_to = legacy_format_msg_values(
+        vacancy[f"{vacancies_table}.salary_to"])
+    salary_currency = legacy_format_msg_values(
+        vacancy[f"{vacancies_table}.salary_currency"])
+    is_before_tax = vacancy[f"{vacancies_table}.salary_gross"]
+    requirement = legacy_format_msg_values(
+        vacancy[f"{vacancies_table}.snippet_requirement"])
+    responsibility = legacy_format_msg_values(
+        vacancy[f"{vacancies_table}.snippet_responsibility"])
+    schedule = legacy_format_msg_values(
+        vacancy[f"{vacancies_table}.schedule_name"])
+    working_time_intervals = legacy_format_msg_values(
+        vacancy[f"{vacancies_table}.working_time_intervals_name"])
+    working_time_modes = legacy_format_msg_values(
+        vacancy[f"{vacancies_table}.working_time_modes_name"])
+    city = legacy_format_msg_values(vacancy[f"{areas_table}.name"])
+    address = legacy_format_msg_values(
+        vacancy[f"{vacancies_table}.address_raw"])
+    created = vacancy[f"{vacancies_table}.created_at"]
+
+    if salary_from and salary_to and salary_from > salary_to:
+        salary_from, salary_to = salary_to, salary_from
+    if salary_currency:
+        salary_currency = salary_currency.upper()
+    if is_before_tax and salary_from:
+        salary_from = int(salary_from - salary_from * income_tax)
+    if is_before_tax and salary_to:
+        salary_to = int(salary_to - salary_to * income_tax)
+    if address:
+        city = ""
+
+    msg = f"<a href='{alternate_url}'>{title}</a>\n\
+<em>{salary_from} - {salary_to} {salary_currency}</em>\n\n\
+{responsibility}\n\n\
+{requirement}\n\n\
+{schedule}, {working_time_intervals}, {working_time_modes}\n\n\
+{city}, {address}\n\n\
+<em>Добавлено: {created}</em>"
+    for old, new in [(", ,", ", "), ("  ", " "), (" \n", "\n"),
+                     (",\n", "\n"), ("\n,", "\n"), ("\n ", "\n")]:
+        msg = msg.replace(old, new)
+    return (msg)
+
+def create_fake_msg_row(number):
+    """
+    Create `send_to_telegram > msg_columns` row of `create_fake_vacancy`.
+    """
+    vacancy = create_fake_vacancy(number)
+    return ({
+        "vacancies.id": int(vacancy["id"]),
+        "vacancies.is_sent": 0,
+        "vacancies.name": vacancy["name"].lower(),
+        "vacancies.alternate_url": vacancy["alternate_url"],
+        "vacancies.salary_from": vacancy["salary"]["from"],
+        "vacancies.salary_to": 200000 if number % 2 else None,
+        "vacancies.salary_currency": vacancy["salary"]["currency"].lower(),
+        "vacancies.salary_gross": int(vacancy["salary"]["gross"]),
+        "vacancies.snippet_responsibility":
+            vacancy["snippet"]["responsibility"],
+        "vacancies.snippet_requirement": vacancy["snippet"]["requirement"],
+        "vacancies.schedule_name": vacancy["schedule"]["name"].lower(),
+        "vacancies.working_time_intervals_name": None,
+        "vacancies.working_time_modes_name": None,
+        "areas.name": "москва",
+        "vacancies.address_raw":
+            vacancy["address"]["raw"].lower() if number % 3 else None,
+        "vacancies.created_at": vacancy["created_at"]
+    })
+
+def benchmark_render_msgs(msgs_number=10000):
+    """
+    Compare legacy `build_msg` with `compile_msg_renderer`
+    and check that they render the same messages.
+    """
+    config = create_benchmark_config(":memory:")
+    vacancies_rows = [create_fake_msg_row(number)
+                      for number in range(msgs_number)]
+    msg_columns = list(vacancies_rows[0])
+    vacancies_tuples = [tuple(vacancy.values()) for vacancy in vacancies_rows]
+
+    start_time = time.perf_counter()
+    legacy_msgs = [legacy_build_msg(vacancy, config)
+                   for vacancy in vacancies_rows]
+    legacy_elapsed = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    render_msg = telegram.compile_msg_renderer(
+        create_benchmark_snapshot(":memory:"), msg_columns)
+    msgs = list(map(render_msg, vacancies_tuples))
+    elapsed = time.perf_counter() - start_time
+    assert msgs == legacy_msgs, "Rendered messages differ from legacy ones"
+    print (f"render {msgs_number} messages: \
+legacy build_msg {legacy_elapsed*1000:.0f} ms, \
+compile_msg_renderer {elapsed*1000:.0f} ms")
+    return (legacy_elapsed, elapsed)
+
+def benchmark_validation_levels(pages_number=50, per_page=100):
+    """
+    Compare ingest and filter time of hh pages under `full`,
+    `sampled` and `off` validation levels.
+    """
+    tables = BENCHMARK_TABLES
+    msg_columns = [
+        f"{tables['vacancies_table']}.id",
+        f"{tables['vacancies_table']}.is_sent",
+        f"{tables['vacancies_table']}.name",
+        f"{tables['vacancies_table']}.alternate_url",
+        f"{tables['vacancies_table']}.salary_from",
+        f"{tables['areas_table']}.name",
+        f"{tables['vacancies_table']}.created_at"
+    ]
+    query_filters = [[], "", ["python"],
+                     f"({tables['vacancies_table']}.name REGEXP ?)"]
+    pages = [[create_fake_vacancy(page * per_page + number)
+              for number in range(per_page)]
+             for page in range(pages_number)]
+
+    elapsed = {}
+    for level in ("full", "sampled", "off"):
+        set_validation_level(level)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            database = str(Path(temp_dir) / "benchmark.db")
+            snapshot = create_benchmark_snapshot(database)
+            create_benchmark_areas_table(database)
+            outbox.create_outbox_table(database, snapshot.outbox_table)
+            start_time = time.perf_counter()
+            for items in pages:
+                vacancies.write_vacancies_to_database(snapshot, items, {1})
+            ingest_elapsed = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            filtered_number = sum(1 for is_clean, vacancy in
+                telegram.filter_vacancies(
+                    snapshot, msg_columns, query_filters))
+            filter_elapsed = time.perf_counter() - start_time
+            shared.close_connections()
+        assert filtered_number == pages_number * per_page, \
+            f"Expected {pages_number * per_page} filtered vacancies, \
+got {filtered_number}"
+        elapsed[level] = (ingest_elapsed, filter_elapsed)
+    set_validation_level("full")
+
+    for level, (ingest_elapsed, filter_elapsed) in elapsed.items():
+        print (f"validation {level}: ingest {pages_number} pages \
+{ingest_elapsed*1000:.0f} ms, filter {pages_number * per_page} vacancies \
+{filter_elapsed*1000:.0f} ms")
+    return (elapsed)
+
+def legacy_read_tables(config):
+    """
+    Config reading of `write_vacancies_to_database` which was used
+    before `ConfigSnapshot`. Kept as benchmark reference.
+    """
+    database = deepcopy(config["database"])
+    vacancies_table = deepcopy(config["tables"]["vacancies_table"])
+    streets_table = deepcopy(config["tables"]["streets_table"])
+    metro_stations_table = deepcopy(config["tables"]["metro_stations_table"])
+    employers_table = deepcopy(config["tables"]["employers_table"])
+    vacancies_metro_stations_table = \
+        deepcopy(config["tables"]["vacancies_metro_stations_table"])
+    return (database, vacancies_table, streets_table, metro_stations_table,
+            employers_table, vacancies_metro_stations_table)
+
+def read_snapshot_tables(snapshot):
+    """
+    `legacy_read_tables` with `ConfigSnapshot`.
+    """
+    database = snapshot.database
+    vacancies_table = snapshot.tables.vacancies_table
+    streets_table = snapshot.tables.streets_table
+    metro_stations_table = snapshot.tables.metro_stations_table
+    employers_table = snapshot.tables.employers_table
+    vacancies_metro_stations_table = \
+        snapshot.tables.vacancies_metro_stations_table
+    return (database, vacancies_table, streets_table, metro_stations_table,
+            employers_table, vacancies_metro_stations_table)
+
+def benchmark_config_snapshot(calls_number=100000):
+    """
+    Compare reading settings with `deepcopy` from ruamel config
+    and from `ConfigSnapshot`.
+    """
+    config = read_config()
+    start_time = time.perf_counter()
+    for _ in range(calls_number):
+        legacy_tables = legacy_read_tables(config)
+    legacy_elapsed = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    snapshot = get_config_snapshot(config)
+    for _ in range(calls_number):
+        tables = read_snapshot_tables(snapshot)
+    elapsed = time.perf_counter() - start_time
+    assert tables == legacy_tables, "Snapshot settings differ from config"
+    print (f"read settings {calls_number} times: \
+deepcopy {legacy_elapsed*1000:.0f} ms, snapshot {elapsed*1000:.0f} ms")
+    return (legacy_elapsed, elapsed)
+
+def main():
+    benchmark_write_to_database()
+    benchmark_write_vacancies_to_database()
+    benchmark_flatten_vacancies()
+    benchmark_regexp()
+    benchmark_render_msgs()
+    benchmark_validation_levels()
+    benchmark_config_snapshot()
+
+if __name__ == "__main__":
+    main()
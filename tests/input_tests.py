@@ -127,6 +127,17 @@ def test_write_to_database_from_dict(database, table, data):
             test_var_len_more_than(value, "value", 0)
     return ()
 
+def test_write_many_to_database(database, table, rows):
+    """
+    Combine all tests for `write_many_to_database`.
+    """
+    test_var_type(rows, "rows", list)
+    test_var_len_more_than(rows, "rows", 0)
+
+    for row in rows:
+        test_write_to_database_from_dict(database, table, row)
+    return ()
+
 # CONFIG TESTS
 def test_read_config(config_path):
     """
@@ -7,7 +7,6 @@ Output tests for hh_parser.
 from copy import deepcopy
 import datetime
 
-from ruamel.yaml import YAML
 import requests
 
 from tests.input_tests import (
@@ -66,19 +65,6 @@ def test_write_to_database(database_changes_number, counter):
       Got %s database changes." % (counter, database_changes_number)
       return ()
 
-# CONFIG TESTS
-def test_write_config(edited_config, config_path="config.yaml"):
-      """
-      Compare new config file with the the old modified one.
-      """
-      with open(config_path, "r", encoding="utf8") as f:
-            yaml = YAML()
-            new_config = yaml.load(f)
-      assert new_config == edited_config, \
-      "\n\nExpected config:\n %s\
-      \n\nGot config:\n %s" % (edited_config, new_config)
-      return ()
-
 # AREAS TESTS
 def test_load_areas_root_length(areas):
       """
@@ -264,27 +250,32 @@ def test_format_filters_to_query(filters, query_filters):
       Test if filters sql parts are syntax correct.
       """
       test_var_type(query_filters, "query_filters", list)
-      test_var_len_equal(query_filters, "query_filters", 3)
+      test_var_len_equal(query_filters, "query_filters", 4)
 
-      patterns = query_filters[0]
-      filters_query_part = query_filters[1]
-      inverse_filters_query_part = query_filters[2]
+      direct_patterns = query_filters[0]
+      direct_query_part = query_filters[1]
+      patterns = query_filters[2]
+      filters_query_part = query_filters[3]
 
+      test_var_type(direct_patterns, "direct_patterns", list)
       test_var_type(patterns, "patterns", list)
-      test_var_len_more_than(patterns, "patterns", len(filters)-1)
-      for pattern in patterns:
+      test_var_len_more_than(
+            direct_patterns + patterns, "patterns", len(filters)-1)
+      for pattern in direct_patterns + patterns:
             test_var_type(pattern, "pattern", str)
 
-      test_var_type(filters_query_part, "filters_query_part", str)
-      test_var_len_more_than(filters_query_part, "filters_query_part", 15)
-      and_substring_count = filters_query_part.count(" AND ")
-      assert (len(filters) - 1) == and_substring_count, \
-      "\n\nExpected %d ` AND ` subsring in `filters_query_part`\n\
-      Got %d ` AND ` ones." % (len(filters)-1, and_substring_count)
-      assert filters_query_part.endswith("?)"), \
-      "Expected `?)` at the end of `filters_query_part`\n\
-      Got %s" % filters_query_part[-2:]
-      assert "LIKE (?," not in filters_query_part,\
+      query_parts_number = 0
+      for query_part, query_part_name in [
+                  (direct_query_part, "direct_query_part"),
+                  (filters_query_part, "filters_query_part")]:
+            test_var_type(query_part, query_part_name, str)
+            if not query_part:
+                  continue
+            query_parts_number += query_part.count(" AND ") + 1
+            assert query_part.endswith("?)"), \
+            "Expected `?)` at the end of `%s`\n\
+            Got %s" % (query_part_name, query_part[-2:])
+            assert "LIKE (?," not in query_part,\
 '\n\nLIKE operator excepts only one pattern:\n\
     valid: "{{table_name}}.{column}": [LIKE, pattern]\n\
     NOT valid: "{{table_name}}.{column}": [LIKE, "pattern_1, pattern_2"]\n\
@@ -293,37 +284,18 @@ Use REGEXP if you need muptiple patterns:\n\
     valid: "{{table_name}}.{column}": \
 [REGEXP, "pattern_1|pattern_2|pattern_3"]\n\
 Try to edit `config.yaml > filters`'
-
-      test_var_type(
-            inverse_filters_query_part, "inverse_filters_query_part", str)
-      test_var_len_more_than(
-            inverse_filters_query_part, "inverse_filters_query_part", 11)
-      or_substring_count = inverse_filters_query_part.count(" OR ")
-      assert max(0, (len(filters) - 3)) == or_substring_count, \
-      "Expected %d ` OR ` subsring in `inverse_filters_query_part`\n\
-      Got %d ` OR ` ones." % \
-      (max(0, (len(filters) - 3)), or_substring_count)
-      assert inverse_filters_query_part.endswith(")"), \
-      "Expected `)` at the end of `inverse_filters_query_part`\n\
-      Got %s" % inverse_filters_query_part[-1:]
+      assert len(filters) == query_parts_number, \
+      "\n\nExpected %d filters in `direct_query_part` and \
+`filters_query_part`\n\
+      Got %d ones." % (len(filters), query_parts_number)
       return ()
 
-def test_filter_vacancies(filtered_vacancies, send_columns):
+def test_filtered_vacancy(filtered_vacancy, msg_columns):
       """
-      Tests for `filtered_vacancies`.
+      Tests for one vacancy yielded by `filter_vacancies`.
       """
-      test_var_type(filtered_vacancies, "filtered_vacancies", list)
-      test_var_len_more_than(filtered_vacancies, "filtered_vacancy", 1)
-      test_var_type(filtered_vacancies[0], "clean_vacancies", list)
-      test_var_type(filtered_vacancies[1], "dirty_vacancies", list)
-
-      for clean_dirty_vacancies in filtered_vacancies:
-            for filtered_vacancy in clean_dirty_vacancies:
-                  test_var_type(filtered_vacancy, "filtered_vacancy", dict)
-                  test_var_len_more_than(filtered_vacancy, "filtered_vacancy", \
-                                         len(send_columns)-1)
-                  for key, value in filtered_vacancy.items():
-                        test_var_type(key, "key", str)
-                        test_var_len_more_than(key, "key", 0)
-                        test_var_type(value, "value", (int, str, type(None)))
+      test_var_type(filtered_vacancy, "filtered_vacancy", tuple)
+      test_var_len_equal(filtered_vacancy, "filtered_vacancy", len(msg_columns))
+      for value in filtered_vacancy:
+            test_var_type(value, "value", (int, str, type(None)))
       return ()
@@ -4,13 +4,217 @@
 unittests for hh_parser.
 """
 
-from config import read_config
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+import datetime
+import json
+import sqlite3
+import tempfile
+import time
+
+from config import get_config_snapshot, read_config
 import areas
+import logs
+import main
+import outbox
+import shared
+import state
 import telegram
+from tests import validation
 import unittest
+import vacancies
+
+# TEST FIXTURES
+# Fixed settings, so unit tests don't depend on user `config.yaml`.
+TEST_CONFIG = {
+    "database": "test.db",
+    "tables": {
+        "areas_table": "areas",
+        "vacancies_table": "vacancies",
+        "streets_table": "streets",
+        "metro_stations_table": "metro_stations",
+        "employers_table": "employers",
+        "vacancies_metro_stations_table": "vacancies_metro_stations"
+    },
+    "state_table": "state",
+    "outbox_table": "outbox",
+    "areas_file": "areas.json",
+    "vacancies_file": "vacancies.json",
+    "clean_vacancies_file_path": "clean_vacancies/",
+    "dirty_vacancies_file_path": "dirty_vacancies/",
+    "income_tax": 0.13,
+    "chat_id": 1,
+    "digest": False,
+    "kill_program_after": 120,
+    "concurrency": 2,
+    "incremental": True,
+    "http_client": {"pool_size": 2, "connect_timeout": 5, "read_timeout": 30,
+                    "rate_limit": 1000, "burst": 1000, "max_retries": 2,
+                    "backoff": 1},
+    "telegram_client": {"pool_size": 2, "concurrency": 2,
+                        "connect_timeout": 5, "read_timeout": 30,
+                        "rate_limit": 1000, "burst": 1000,
+                        "chat_rate_limit": 1000, "chat_burst": 1000,
+                        "max_retries": 2, "backoff": 1,
+                        "outbox_batch_size": 20, "max_attempts": 2},
+    "daemon": {"interval": 300, "jitter": 30},
+    "headers": {"user-agent": "hh_parser unit tests"}
+}
+
+def create_test_snapshot(database):
+    """
+    Create config snapshot of `TEST_CONFIG` for `database`.
+    Debugging files are written next to `database`.
+    """
+    directory = Path(database).parent
+    return (get_config_snapshot(dict(
+        TEST_CONFIG, database=database,
+        areas_file=str(directory / "areas.json"),
+        vacancies_file=str(directory / "vacancies.json"),
+        clean_vacancies_file_path=str(directory / "clean_vacancies"),
+        dirty_vacancies_file_path=str(directory / "dirty_vacancies"))))
+
+def create_test_areas_table(database, areas=((1, 113, "москва"),)):
+    """
+    Create areas table with `areas` == (id, parent_id, name) rows.
+    """
+    shared.create_table(database, TEST_CONFIG["tables"]["areas_table"], [
+        "id INT NOT NULL PRIMARY KEY",
+        "parent_id INT",
+        "name TEXT NOT NULL"
+    ])
+    shared.write_many_to_database(
+        database, TEST_CONFIG["tables"]["areas_table"], [
+            {"id": id_, "parent_id": parent_id, "name": name}
+            for id_, parent_id, name in areas])
+    return ()
+
+def create_test_vacancy(number, published_at="2021-08-30T18:00:00+0300"):
+    """
+    Create small hh-like vacancy item (see `load_vacancies` response `items`).
+    """
+    return ({
+        "id": str(1000000 + number),
+        "name": f"python developer {number}",
+        "area": {"id": "1", "name": "москва",
+                 "url": "https://api.hh.ru/areas/1"},
+        "salary": {"from": 100000 + number, "to": None, "currency": "RUR",
+                   "gross": True},
+        "address": {"city": "москва", "street": "улица",
+                    "metro_stations": [
+                        {"station_name": "арбатская", "line_name": "филёвская",
+                         "station_id": "4.2", "line_id": "4",
+                         "lat": 55.75, "lng": 37.6}]},
+        "employer": {"id": "1", "name": "employer",
+                     "vacancies_url": "https://api.hh.ru/vacancies"},
+        "published_at": published_at,
+        "alternate_url": f"https://hh.ru/vacancy/{number}"
+    })
+
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Test case with temporary database and its config snapshot.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database = str(Path(self.temp_dir.name) / "test.db")
+        self.snapshot = create_test_snapshot(self.database)
+
+    def tearDown(self):
+        shared.close_connections()
+        self.temp_dir.cleanup()
 
 # SHARED TESTS
+class TestSingleInstanceLock(unittest.TestCase):
+    def test_single_instance_lock(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lock_path = str(Path(temp_dir) / "hh.lock")
+            with shared.single_instance_lock(lock_path) as is_locked:
+                self.assertTrue(is_locked)
+                with shared.single_instance_lock(lock_path) as is_locked:
+                    self.assertFalse(is_locked)
+            with shared.single_instance_lock(lock_path) as is_locked:
+                self.assertTrue(is_locked)
+
+class TestHttpGet(unittest.TestCase):
+    class Response:
+        def __init__(self, status_code, headers=None):
+            self.status_code = status_code
+            self.headers = headers or {}
+
+    class Session:
+        def __init__(self, responses):
+            self.responses = list(responses)
+            self.calls = 0
+
+        def get(self, url, params, timeout):
+            self.calls += 1
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return (response)
 
+    def http_get(self, responses):
+        """
+        Call `http_get` with stubbed session answering `responses`.
+        Return (response, session, sleep mock).
+        """
+        session = self.Session(responses)
+        with mock.patch.multiple(
+                shared, _http_session=session,
+                _http_rate_limiter=shared.RateLimiter(1000, 1000)), \
+             mock.patch.object(shared.time, "sleep") as sleep:
+            response = shared.http_get(
+                create_test_snapshot("test.db"), "https://api.hh.ru/areas")
+        return (response, session, sleep)
+
+    def test_retry_after(self):
+        response, session, sleep = self.http_get([
+            self.Response(429, {"Retry-After": "3"}), self.Response(200)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session.calls, 2)
+        sleep.assert_called_once_with(3.0)
+
+    def test_backoff_without_retry_after(self):
+        response, session, sleep = self.http_get([
+            self.Response(429), self.Response(503), self.Response(200)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session.calls, 3)
+        backoff = TEST_CONFIG["http_client"]["backoff"]
+        for attempt, ((retry_delay,), kwargs) in enumerate(
+                sleep.call_args_list):
+            self.assertGreaterEqual(retry_delay, 0)
+            self.assertLessEqual(retry_delay, backoff * 2**attempt)
+
+    def test_attempts_limit(self):
+        max_retries = TEST_CONFIG["http_client"]["max_retries"]
+        response, session, sleep = self.http_get(
+            [self.Response(502)] * (max_retries + 1))
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(session.calls, max_retries + 1)
+        self.assertEqual(sleep.call_count, max_retries)
+        with self.assertRaises(shared.requests.ConnectionError):
+            self.http_get([shared.requests.ConnectionError()] *
+                          (max_retries + 1))
+
+    def test_no_retry(self):
+        response, session, sleep = self.http_get([
+            self.Response(404), self.Response(200)])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(session.calls, 1)
+        sleep.assert_not_called()
+        response, session, sleep = self.http_get([
+            shared.requests.Timeout(), self.Response(200)])
+        self.assertEqual(response.status_code, 200)
+
+    def test_retry_after_date(self):
+        retry_date = datetime.datetime.now(datetime.timezone.utc) + \
+            datetime.timedelta(seconds=60)
+        response = self.Response(429, {"Retry-After": retry_date.strftime(
+            "%a, %d %b %Y %H:%M:%S GMT")})
+        self.assertAlmostEqual(
+            shared.get_retry_delay(response, 0, 1), 60, delta=2)
 
 # AREAS TESTS
 class TestSelectAreasByName(unittest.TestCase):
@@ -59,38 +263,258 @@ class TestSelectAreasByName(unittest.TestCase):
             self.assertRaises(AssertionError, areas.select_areas_by_name, \
                               database, areas_table, [invalid_name])
 
+class TestHeadlessAreas(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_areas_table(self.database, (
+            (1, 113, "москва"), (2, 1, "московский"), (3, 113, "новая москва"),
+            (4, 113, "санкт-петербург")))
+
+    def select_headless_area(self, user_area):
+        return (areas.select_headless_area(
+            self.database, self.snapshot.tables.areas_table, user_area))
+
+    def test_select_headless_area(self):
+        self.assertEqual(self.select_headless_area("москва"),
+                         (1, 113, "москва"))
+        self.assertEqual(self.select_headless_area("Петербург"),
+                         (4, 113, "санкт-петербург"))
+        self.assertEqual(self.select_headless_area("2"), (2, 1, "московский"))
+        with self.assertRaisesRegex(ValueError, "`казань` is not found"):
+            self.select_headless_area("казань")
+        with self.assertRaisesRegex(ValueError, "`99` is not found"):
+            self.select_headless_area("99")
+        with self.assertRaisesRegex(
+                ValueError, "`моск` is ambiguous, it matches 3 regions"):
+            self.select_headless_area("моск")
+
+    def test_resolve_headless_areas(self):
+        config = {"url_params": {"area": ["REGEXP", "1"],
+                                 "date_from": "2021-08-30T18:00:00"},
+                  "filters": {"{areas_table}.id": ["REGEXP", "1"]}}
+        config = areas.resolve_headless_areas(self.snapshot, config)
+        self.assertEqual(config["url_params"]["area"], ["REGEXP", "1"])
+        self.assertIn("date_from", config["url_params"])
+        config = areas.resolve_headless_areas(
+            self.snapshot, config, ["москва"])
+        self.assertIn("date_from", config["url_params"])
+        config = areas.resolve_headless_areas(
+            self.snapshot, config, ["москва", "санкт-петербург"])
+        self.assertEqual(config["filters"]["{areas_table}.id"],
+                         ["REGEXP", "1|4"])
+        self.assertNotIn("date_from", config["url_params"])
+
 # VACANCIES TESTS
+class TestSplitVacanciesFilters(unittest.TestCase):
+    def test_split_by_dates(self):
+        filters = {
+            "per_page": 100,
+            "area": ["1", "2"],
+            "date_from": "2021-08-30T00:00:00",
+            "page": 0
+        }
+        splitted_filters = vacancies.split_vacancies_filters(
+            filters, "2021-08-31T00:00:00", 1)
+        self.assertEqual(
+            [(f["date_from"], f["date_to"]) for f in splitted_filters],
+            [("2021-08-30T00:00:00", "2021-08-30T12:00:00"),
+             ("2021-08-30T12:00:00", "2021-08-31T00:00:00")]
+        )
+
+    def test_split_by_period(self):
+        filters = {"per_page": 100, "page": 0}
+        splitted_filters = vacancies.split_vacancies_filters(
+            filters, "2021-08-31T00:00:00", 2)
+        self.assertEqual(splitted_filters[0]["date_from"], "2021-08-29T00:00:00")
+        self.assertEqual(splitted_filters[1]["date_to"], "2021-08-31T00:00:00")
+
+    def test_split_by_areas(self):
+        filters = {
+            "area": ["1", "2", "3"],
+            "date_from": "2021-08-30T00:00:00",
+            "date_to": "2021-08-30T00:00:01",
+            "page": 0
+        }
+        splitted_filters = vacancies.split_vacancies_filters(
+            filters, "2021-08-31T00:00:00", 1)
+        self.assertEqual(
+            [f["area"] for f in splitted_filters], [["1"], ["2", "3"]])
+
+        filters["area"] = ["1"]
+        self.assertEqual(vacancies.split_vacancies_filters(
+            filters, "2021-08-31T00:00:00", 1), [])
+
+
+class TestGetVacancyHash(unittest.TestCase):
+    def test_get_vacancy_hash(self):
+        vacancy = {"id": "42", "name": "python developer", "salary_from": 100}
+        content_hash = vacancies.get_vacancy_hash(vacancy)
+        self.assertEqual(content_hash, vacancies.get_vacancy_hash(
+            dict(vacancy, is_sent=1, content_hash="old")))
+        self.assertNotEqual(content_hash, vacancies.get_vacancy_hash(
+            dict(vacancy, salary_from=200)))
+
+    def test_is_same_database_value(self):
+        self.assertTrue(vacancies.is_same_database_value(True, 1))
+        self.assertTrue(vacancies.is_same_database_value(55.7, "55.7"))
+        self.assertTrue(vacancies.is_same_database_value(None, None))
+        self.assertFalse(vacancies.is_same_database_value(None, 0))
+        self.assertFalse(vacancies.is_same_database_value("a", "b"))
+
+class TestUpsertVacancies(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vacancies_table = self.snapshot.tables.vacancies_table
+        create_test_areas_table(self.database)
+
+    def select_vacancies(self):
+        connection = shared.get_connection(self.database)
+        return ({row[0]: row[1:] for row in connection.execute(
+            f"SELECT id, is_sent, salary_from FROM {self.vacancies_table}")})
+
+    def test_upsert_vacancies(self):
+        items = [create_test_vacancy(number) for number in range(3)]
+        self.assertEqual(vacancies.write_vacancies_to_database(
+            self.snapshot, items, {1}), set())
+        connection = shared.get_connection(self.database)
+        connection.execute(f"UPDATE {self.vacancies_table} SET is_sent = 1 \
+WHERE id = ?", [1000000])
+        self.assertEqual(self.select_vacancies(), {
+            1000000: (1, 100000), 1000001: (0, 100001), 1000002: (0, 100002)})
+
+        items[0]["salary"]["from"] = 200000
+        items[2]["area"]["id"] = "2"
+        self.assertEqual(vacancies.write_vacancies_to_database(
+            self.snapshot, items, {1}), {2})
+        self.assertEqual(self.select_vacancies(), {
+            1000000: (1, 200000), 1000001: (0, 100001), 1000002: (0, 100002)})
+
+        items[0]["salary"]["from"] = 300000
+        vacancy = vacancies.create_vacancy_records(
+            vacancies.flatten_vacancy(items[0]))[0]
+        self.assertEqual(vacancies.upsert_vacancies(
+            self.database, self.vacancies_table, [vacancy]), (0, 1, 0))
+        self.assertEqual(self.select_vacancies()[1000000], (1, 300000))
+
+        vacancy = vacancies.create_vacancy_records(
+            vacancies.flatten_vacancy(items[1]))[0]
+        total_changes = connection.total_changes
+        self.assertEqual(vacancies.upsert_vacancies(
+            self.database, self.vacancies_table, [vacancy]), (0, 0, 1))
+        self.assertEqual(connection.total_changes, total_changes)
+
+class TestGetVacancies(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        create_test_areas_table(self.database)
+        self.config = {
+            "url_params": {"period": 1, "per_page": 2,
+                           "area": ["REGEXP", "1"]},
+            "filters": {"{areas_table}.id": ["REGEXP", "1"]}
+        }
+        self.hh_vacancies = []
+        self.hh_requests = []
+
+    def load_vacancies(self, snapshot, filters):
+        """
+        Fake hh: vacancies published since `date_from`, the newest first.
+        """
+        self.hh_requests.append(filters)
+        items = [item for item in self.hh_vacancies
+                 if "date_from" not in filters or vacancies.get_local_date(
+                     item["published_at"]) >= filters["date_from"]]
+        items.sort(key=lambda item: item["published_at"], reverse=True)
+        per_page = filters["per_page"]
+        page = filters["page"]
+        return ({"items": items[page*per_page:(page + 1)*per_page],
+                 "found": len(items), "page": page, "per_page": per_page,
+                 "pages": -(-len(items) // per_page)})
+
+    def get_vacancies(self):
+        self.hh_requests = []
+        with mock.patch.object(
+                vacancies, "load_vacancies", self.load_vacancies):
+            vacancies.get_vacancies(self.snapshot, self.config)
+        return (len(self.hh_requests))
+
+    def test_incremental_sessions(self):
+        self.hh_vacancies = [create_test_vacancy(
+            number, f"2021-08-30T18:{number:02d}:00+0300")
+                             for number in range(5)]
+        self.assertEqual(self.get_vacancies(), 3)
+        self.assertEqual(self.config["high_water_mark"], {
+            "published_at": "2021-08-30T18:04:00+0300", "id": 1000004})
+        self.assertEqual(self.config["url_params"]["date_from"],
+                         vacancies.get_local_date("2021-08-30T18:04:00+0300"))
+
+        # Next window starts at the newest vacancy: one page holds new
+        # and stored vacancies.
+        self.hh_vacancies.append(
+            create_test_vacancy(5, "2021-08-30T18:05:00+0300"))
+        self.assertEqual(self.get_vacancies(), 1)
+        self.assertEqual(self.config["high_water_mark"]["id"], 1000005)
+
+        # Page of stored vacancies only stops loading.
+        self.assertEqual(self.get_vacancies(), 1)
+        connection = shared.get_connection(self.database)
+        self.assertEqual(connection.execute(
+            f"SELECT COUNT(*) FROM {self.snapshot.tables.vacancies_table}")
+                         .fetchone()[0], 6)
+        self.assertEqual(state.read_state(
+            self.database, self.snapshot.state_table)["high_water_mark"],
+                         self.config["high_water_mark"])
 
 # TELEGRAM TESTS
+class TestGetFiltersPlanKey(DatabaseTestCase):
+    def test_get_filters_plan_key(self):
+        def get_key(filters):
+            return (telegram.get_filters_plan_key(self.snapshot, filters))
+
+        key = get_key({"{areas_table}.id": ["IN", [1, "2"]],
+                       "{vacancies_table}.is_sent": ["==", 0]})
+        self.assertEqual(key, get_key({
+            "{areas_table}.id": ["IN", "1, 2"],
+            "{vacancies_table}.is_sent": ["==", "0"]}))
+        self.assertNotEqual(key, get_key({
+            "{areas_table}.id": ["IN", [1.0, 2]],
+            "{vacancies_table}.is_sent": ["==", 0]}))
+        self.assertNotEqual(key, get_key({
+            "{vacancies_table}.is_sent": ["==", 0],
+            "{areas_table}.id": ["IN", [1, 2]]}))
+
+class TestRegexp(unittest.TestCase):
+    def test_regexp(self):
+        self.assertTrue(telegram.regexp(r"^1$", 1))
+        self.assertFalse(telegram.regexp(r"^1$", 1.0))
+        self.assertTrue(telegram.regexp(r"^1\.0$", 1.0))
+        self.assertFalse(telegram.regexp(r"^1\.0$", 1))
+        self.assertFalse(telegram.regexp(r"^1$", None))
+
 class TestFormatFiltersToQuery(unittest.TestCase):
     def test_format_filters_to_query(self):
-        config = read_config()
-        areas_table = config["tables"]["areas_table"]
-        vacancies_table = config["tables"]["vacancies_table"]
+        snapshot = get_config_snapshot(read_config())
 
         filters = {
             "{vacancies_table}.name": ["NOT REGEXP", "прода"]
         }
         query_filters = \
-            telegram.format_filters_to_query(filters, config)
-        filters_query_part = query_filters[1]
-        inverse_filters_query_part = query_filters[2]
+            telegram.format_filters_to_query(snapshot, filters)
+        direct_query_part = query_filters[1]
+        filters_query_part = query_filters[3]
+        self.assertEqual(direct_query_part, "")
         self.assertEqual(
         filters_query_part, "vacancies.name NOT REGEXP (?)")
-        self.assertEqual(
-        inverse_filters_query_part, "(vacancies.name REGEXP (?))")
 
         filters = {
             "{vacancies_table}.name": ["NOT REGEXP", "гара", "нед"]
         }
         query_filters = \
-            telegram.format_filters_to_query(filters, config)
-        filters_query_part = query_filters[1]
-        inverse_filters_query_part = query_filters[2]
+            telegram.format_filters_to_query(snapshot, filters)
+        direct_query_part = query_filters[1]
+        filters_query_part = query_filters[3]
+        self.assertEqual(direct_query_part, "")
         self.assertEqual(
         filters_query_part, "vacancies.name NOT REGEXP (?)")
-        self.assertEqual(
-        inverse_filters_query_part, "(vacancies.name REGEXP (?))")
 
         filters = {
             "{vacancies_table}.is_sent": ["==", 1],
@@ -99,17 +523,18 @@ class TestFormatFiltersToQuery(unittest.TestCase):
             "{vacancies_table}.snippet_responsibility": ["LIKE", "вд40"]
         }
         query_filters = \
-            telegram.format_filters_to_query(filters, config)
-        filters_query_part = query_filters[1]
-        inverse_filters_query_part = query_filters[2]
+            telegram.format_filters_to_query(snapshot, filters)
+        direct_patterns = query_filters[0]
+        direct_query_part = query_filters[1]
+        patterns = query_filters[2]
+        filters_query_part = query_filters[3]
+        self.assertEqual(direct_patterns, ["1", "42"])
         self.assertEqual(
-        filters_query_part, "vacancies.is_sent == (?) AND areas.id REGEXP (?) \
-AND vacancies.name NOT REGEXP (?) AND \
-vacancies.snippet_responsibility LIKE (?)")
+        direct_query_part, "vacancies.is_sent == (?) AND areas.id REGEXP (?)")
+        self.assertEqual(patterns, ["пиш", "вд40"])
         self.assertEqual(
-        inverse_filters_query_part, "vacancies.is_sent == (?) AND \
-areas.id REGEXP (?) AND (vacancies.name REGEXP (?) OR \
-vacancies.snippet_responsibility NOT LIKE (?))")
+        filters_query_part, "vacancies.name NOT REGEXP (?) AND \
+vacancies.snippet_responsibility LIKE (?)")
 
 class TestFormatMsgValues(unittest.TestCase):
     def test_format_msg_values(self):
@@ -150,5 +575,238 @@ class TestFormatMsgValues(unittest.TestCase):
 Именно так."
             )
 
+class TestGetTelegramRetryAfter(unittest.TestCase):
+    class Response:
+        def __init__(self, data):
+            self.data = data
+
+        def json(self):
+            if self.data is None:
+                raise ValueError
+            return (self.data)
+
+    def test_get_telegram_retry_after(self):
+        response = self.Response({
+            "ok": False,
+            "error_code": 429,
+            "description": "Too Many Requests: retry after 7",
+            "parameters": {"retry_after": 7}
+        })
+        self.assertEqual(telegram.get_telegram_retry_after(response), 7)
+        response = self.Response({"ok": False, "error_code": 429})
+        self.assertIsNone(telegram.get_telegram_retry_after(response))
+        response = self.Response(None)
+        self.assertIsNone(telegram.get_telegram_retry_after(response))
+
+class TestPackDigest(unittest.TestCase):
+    def test_pack_digest(self):
+        digest = [[], [], 0]
+        msg = "<a href='url'>title</a>\n" + "x" * 40
+        packed = []
+        for vacancy_id in range(10):
+            packed.append(telegram.pack_digest(
+                digest, vacancy_id, msg, max_length=200))
+        packed = [digest for digest in packed if digest is not None]
+        packed.append(telegram.flush_digest(digest))
+        self.assertEqual(digest, [[], [], 0])
+        self.assertEqual(
+            [vacancy_id for vacancies_ids, msgs in packed
+             for vacancy_id in vacancies_ids], list(range(10)))
+        for vacancies_ids, msgs in packed:
+            self.assertLessEqual(
+                len(telegram.DIGEST_SEPARATOR.join(msgs)), 200)
+            self.assertEqual(msgs, [msg] * len(vacancies_ids))
+
+    def test_cut_msg(self):
+        msg = "<a href='url'>title</a>\n<em>salary</em>\n" + "x" * 100
+        self.assertEqual(telegram.cut_msg(msg), msg)
+        self.assertEqual(telegram.cut_msg(msg, max_length=50),
+                         "<a href='url'>title</a>\n<em>salary</em>\n...")
+
+# OUTBOX TESTS
+class TestOutbox(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.outbox_table = self.snapshot.outbox_table
+        self.vacancies_table = self.snapshot.tables.vacancies_table
+        create_test_areas_table(self.database)
+        shared.create_table(self.database, self.vacancies_table, [
+            "id INTEGER NOT NULL PRIMARY KEY",
+            "is_sent INT NOT NULL",
+            "area_id INT"
+        ])
+        shared.write_many_to_database(self.database, self.vacancies_table, [
+            {"id": vacancy_id, "is_sent": 0, "area_id": 1}
+            for vacancy_id in range(1, 4)])
+        outbox.create_outbox_table(self.database, self.outbox_table)
+
+    def select_outbox(self):
+        connection = shared.get_connection(self.database)
+        return ({row[0]: row[1:] for row in connection.execute(
+            f"SELECT vacancy_id, state, attempts FROM {self.outbox_table}")})
+
+    def select_sent_ids(self):
+        connection = shared.get_connection(self.database)
+        return ({row[0] for row in connection.execute(
+            f"SELECT id FROM {self.vacancies_table} WHERE is_sent = 1")})
+
+    def finish(self, results, max_attempts=2):
+        return (outbox.finish_outbox_batch(
+            self.database, self.outbox_table, self.vacancies_table,
+            results, max_attempts))
+
+    def test_recover_outbox(self):
+        outbox.mark_in_flight(self.database, self.outbox_table, [1, 2])
+        self.finish([(1, "sent")])
+        self.assertEqual(outbox.recover_outbox(
+            self.database, self.outbox_table), 1)
+        self.assertEqual(self.select_outbox(),
+                         {1: ("sent", 1), 2: ("queued", 1)})
+        self.assertEqual(outbox.recover_outbox(
+            self.database, self.outbox_table), 0)
+
+    def test_failed_attempts(self):
+        outbox.mark_in_flight(self.database, self.outbox_table, [1, 2])
+        self.assertEqual(self.finish([(1, "failed"), (2, "queued")]), 0)
+        self.assertEqual(self.select_outbox(),
+                         {1: ("queued", 1), 2: ("queued", 0)})
+        outbox.mark_in_flight(self.database, self.outbox_table, [1])
+        self.finish([(1, "failed")])
+        self.assertEqual(self.select_outbox()[1], ("failed", 2))
+        self.assertEqual(outbox.select_outbox_ids(
+            self.database, self.outbox_table, "failed"), {1})
+        self.assertEqual(self.select_sent_ids(), set())
+
+    def test_sent_in_one_transaction(self):
+        outbox.mark_in_flight(self.database, self.outbox_table, [1, 3])
+        self.assertEqual(self.finish([(1, "sent"), (3, "sent")]), 2)
+        self.assertEqual(self.select_outbox(),
+                         {1: ("sent", 1), 3: ("sent", 1)})
+        self.assertEqual(self.select_sent_ids(), {1, 3})
+
+        # Failed `is_sent` update rolls back outbox state too.
+        outbox.mark_in_flight(self.database, self.outbox_table, [2])
+        with self.assertRaises(sqlite3.OperationalError):
+            outbox.finish_outbox_batch(self.database, self.outbox_table,
+                                       "missing_table", [(2, "sent")], 2)
+        self.assertEqual(self.select_outbox()[2], ("in_flight", 0))
+        self.assertEqual(self.select_sent_ids(), {1, 3})
+
+    def test_failed_digest(self):
+        posted = []
+        def post_telegram_message(snapshot, token, msg_params, stop_time):
+            posted.append(msg_params["text"])
+            return ("failed" if "bad" in msg_params["text"] else "sent")
+
+        with mock.patch.object(
+                telegram, "post_telegram_message", post_telegram_message), \
+             ThreadPoolExecutor(max_workers=2) as executor:
+            sent_number = telegram.send_outbox_batch(
+                self.snapshot, executor, "token", {}, [
+                    ([1, 2], ["good", "bad"]), ([3], ["good"])], None)
+        self.assertEqual(sent_number, 2)
+        self.assertEqual(len(posted), 4)
+        self.assertEqual(self.select_sent_ids(), {1, 3})
+        self.assertEqual(self.select_outbox(), {
+            1: ("sent", 1), 2: ("queued", 1), 3: ("sent", 1)})
+
+    def test_filter_skips_failed(self):
+        outbox.mark_in_flight(self.database, self.outbox_table, [1, 2])
+        self.finish([(1, "failed"), (2, "failed")], max_attempts=1)
+        outbox.mark_in_flight(self.database, self.outbox_table, [3])
+        self.finish([(3, "failed")])
+        filtered = telegram.filter_vacancies(
+            self.snapshot, [f"{self.vacancies_table}.id"],
+            [[], "", [], ""])
+        self.assertEqual([vacancy for is_clean, vacancy in filtered], [(3,)])
+
+    def test_cut_off_retry_is_queued(self):
+        class Response:
+            status_code = 502
+            headers = {}
+        class Session:
+            def post(self, url, json, timeout):
+                time.sleep(0.2)
+                return (Response())
+
+        snapshot = self.snapshot._replace(
+            telegram_client=self.snapshot.telegram_client._replace(
+                backoff=0.01))
+        stop_time = datetime.datetime.now() + datetime.timedelta(seconds=0.1)
+        with mock.patch.multiple(
+                telegram, _telegram_session=Session(),
+                _telegram_rate_limiter=shared.RateLimiter(1000, 1000),
+                _telegram_chat_rate_limiter=shared.RateLimiter(1000, 1000)):
+            self.assertEqual(telegram.post_telegram_message(
+                snapshot, "token", {}, stop_time), "queued")
+
+# LOGS TESTS
+class TestJsonLinesHandler(unittest.TestCase):
+    def tearDown(self):
+        for handler in logs.logger.handlers[:]:
+            logs.logger.removeHandler(handler)
+            handler.close()
+        logs.logger.addHandler(logs.logging.NullHandler())
+
+    def test_json_lines_handler(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_name = str(Path(temp_dir) / "log" / "hh.jsonl")
+            logs.setup_logging({"logging": {"level": "ERROR",
+                "file": file_name, "file_level": "DEBUG", "buffer_size": 3}})
+            logs.count_stage("test", "rows", 2)
+            logs.count_stage("test", "rows")
+            logs.logger.debug("    first")
+            logs.log_stage_counters("test")
+            self.assertFalse(Path(file_name).exists())
+            logs.logger.debug("second")
+            with open(file_name, encoding="utf8") as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual([line["message"] for line in lines],
+                             ["first", "test: rows 3", "second"])
+            self.assertEqual(lines[1]["counters"], {"rows": 3})
+            self.assertNotIn("test", logs.stage_counters)
+            logs.logger.error("third")
+            with open(file_name, encoding="utf8") as f:
+                self.assertEqual(len(f.readlines()), 4)
+
+# MAIN TESTS
+class TestRunDaemon(unittest.TestCase):
+    def test_run_daemon(self):
+        snapshot = create_test_snapshot("test.db")
+        config = {}
+        with mock.patch.object(main, "run_session", side_effect=[
+                ValueError("bad hh response"), None,
+                sqlite3.OperationalError("database is locked"),
+                KeyboardInterrupt]) as run_session, \
+             mock.patch.object(main.time, "sleep") as sleep:
+            with self.assertRaises(KeyboardInterrupt):
+                main.run_daemon(snapshot, config)
+        self.assertEqual(run_session.call_count, 4)
+        run_session.assert_called_with(snapshot, config)
+        self.assertEqual(sleep.call_count, 3)
+        interval = snapshot.daemon.interval
+        jitter = snapshot.daemon.jitter
+        for (sleep_time,), kwargs in sleep.call_args_list:
+            self.assertLessEqual(sleep_time, interval + jitter)
+            self.assertGreaterEqual(sleep_time, interval - jitter - 1)
+
+# VALIDATION TESTS
+class TestIsValidated(unittest.TestCase):
+    def tearDown(self):
+        validation.set_validation_level("full")
+
+    def test_is_validated(self):
+        validation.set_validation_level("sampled", 3)
+        self.assertEqual(
+            [validation.is_validated("rows") for row in range(7)],
+            [True, False, False, True, False, False, True])
+        self.assertTrue(validation.is_validated("other_rows"))
+        validation.set_validation_level("off")
+        self.assertFalse(validation.is_validated("rows"))
+        validation.set_validation_level("full")
+        self.assertTrue(validation.is_validated("rows"))
+        with self.assertRaises(AssertionError):
+            validation.set_validation_level("partial")
+
 if __name__ == "__main__":
     unittest.main()
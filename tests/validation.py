@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+"""
+Validation level of runtime tests for hh_parser.
+Run boundary tests (config, function arguments, database changes)
+are always on. Per-row tests in ingest and filter loops run under
+`validation` level from config:
+- full: every row is tested;
+- sampled: 1 of `sample_rate` rows is tested per check;
+- off: per-row tests are skipped.
+"""
+
+from collections import defaultdict
+from itertools import count
+
+import tests.input_tests as in_tests
+
+VALIDATION_LEVELS = ("full", "sampled", "off")
+
+# Unit tests and benchmarks run with full validation,
+# `main` sets level from config.
+validation = {"level": "full", "sample_rate": 100}
+# `next` on `itertools.count` is atomic, so counters are thread safe.
+checks_counters = defaultdict(count)
+
+def set_validation_level(level, sample_rate=100):
+    """
+    Set per-row tests level and reset checks counters.
+    """
+    in_tests.test_var_type(level, "level", str)
+    assert level in VALIDATION_LEVELS, \
+        f"\n\nExpected validation level in {VALIDATION_LEVELS}.\n\
+Got `{level}`."
+    in_tests.test_var_type(sample_rate, "sample_rate", int)
+    assert sample_rate > 0, \
+        f"\n\nExpected sample_rate > 0.\nGot {sample_rate}."
+
+    validation["level"] = level
+    validation["sample_rate"] = sample_rate
+    checks_counters.clear()
+    return ()
+
+def is_validated(check):
+    """
+    Return True if per-row `check` should run for the current row.
+    """
+    level = validation["level"]
+    if level == "full":
+        return (True)
+    if level == "off":
+        return (False)
+    return (next(checks_counters[check]) % validation["sample_rate"] == 0)
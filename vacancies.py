@@ -8,72 +8,139 @@ https://github.com/hhru/api/blob/master/docs_eng/README.md
 https://github.com/hhru/api/blob/master/docs_eng/vacancies.md
 """
 
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
 import datetime
+import hashlib
+import json
 import math
-import types
 
-import requests
-
-from areas import check_if_area_id_is_in_areas_table
-from config import import_database_columns
+from areas import select_areas_ids, update_areas_with_unknown_ids
 from shared import (
     create_table,
     create_table_columns,
+    get_connection,
     get_table_columns_names,
-    write_to_database,
+    http_get,
+    is_table_exists,
+    log_http_latencies,
+    transaction,
+    write_many_to_database,
     write_to_file
 )
+from logs import count_stage, log_stage_counters, logger
+from state import save_state
 import tests.input_tests as in_tests
 import tests.output_tests as out_tests
+from tests.validation import is_validated
 
-def get_vacancies(config):
+def get_vacancies(snapshot, config):
     """
     Load vacancies from hh, save them to file (for debugging) and database.
+    If hh finds more vacancies than it can return for one query, the query is
+    split into slices (see `load_vacancies_slices`).
+    After slices first pages all the rest pages are loaded in parallel
+    (up to `config.yaml > concurrency` at once) and written in pages order.
+    In incremental mode pages are sorted by publication date and loaded one by
+    one until a page holds only stored vacancies
+    (see `load_new_vacancies_pages`). If hh finds more vacancies than it can
+    return for one query, incremental mode falls back to slices.
+    Next session starts at the newest vacancy got so far (`high_water_mark`),
+    so its window overlaps stored vacancies.
     """
-    vacancies_file = deepcopy(config["vacancies_file"])
-    headers = deepcopy(config["headers"])
-    filters = deepcopy(config["url_params"])
+    database = snapshot.database
+    areas_table = snapshot.tables.areas_table
+    vacancies_file = snapshot.vacancies_file
+    concurrency = snapshot.concurrency
+    incremental = snapshot.incremental
+    high_water_mark = config.get("high_water_mark")
+    period = config["url_params"].get("period", 30)
+    filters = dict(config["url_params"])
     filters["area"] = filters["area"][-1].split("|")
     if filters["area"] == [""]:
         del filters["area"]
-    if "date_from"  or "date_to" in filters:
-        del filters["period"]
+    if "date_from" in filters or "date_to" in filters:
+        filters.pop("period", None)
+    if incremental:
+        filters["order_by"] = "publication_time"
     filters["page"] = 0
     in_tests.test_dict_data_type(filters)
-    print ("\n\nGetting vacancies from hh...")
+    in_tests.test_var_type(concurrency, "concurrency", int)
+    in_tests.test_var_type(incremental, "incremental", bool)
+    in_tests.test_var_type(period, "period", int)
+    logger.info("\n\nGetting vacancies from hh...")
 
     date_current = datetime.datetime.now().replace(microsecond=0).isoformat()
-    while True:
-        vacancies = load_vacancies(headers, filters)
-        found_vacancies = vacancies["found"]
-        if found_vacancies:
-            write_vacancies_to_database(
-                config, create_vacancies_generator(vacancies["items"]))
-        write_to_file(vacancies_file, vacancies)
-        filters["page"] += 1
-        if vacancies["pages"] <= filters["page"]:
-            break
-    config["url_params"]["date_from"] = date_current
-    import_database_columns(config)
-    got_vacancies = min(found_vacancies, filters["per_page"]*filters["page"])
+    first_page = load_vacancies(snapshot, filters)
+    found_vacancies = first_page["found"]
+    vacancies_ids = set()
+    areas_ids = select_areas_ids(database, areas_table)
+    unknown_areas_ids = set()
+    is_incremental = incremental and is_vacancies_slice_complete(first_page)
+    if incremental and not is_incremental:
+        logger.info(f"    hh found {found_vacancies} vacancies, more than \
+one query returns. Loading them by slices instead of incremental mode...")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if is_incremental:
+            pages = load_new_vacancies_pages(snapshot, filters, first_page)
+        else:
+            slices = load_vacancies_slices(
+                snapshot, executor, filters, first_page, date_current, period)
+            pages_filters = [dict(slice_filters, page=page)
+                             for slice_filters, slice_page in slices
+                             for page in range(1, slice_page["pages"])]
+            rest_pages = executor.map(
+                partial(load_vacancies, snapshot), pages_filters)
+            pages = chain(
+                [slice_page for _, slice_page in slices], rest_pages)
+        for vacancies in pages:
+            # Slices can overlap at their dates borders.
+            items = [item for item in vacancies["items"]
+                     if item["id"] not in vacancies_ids]
+            vacancies_ids.update(item["id"] for item in items)
+            high_water_mark = get_high_water_mark(items, high_water_mark)
+            if items:
+                unknown_areas_ids |= write_vacancies_to_database(
+                    snapshot, items, areas_ids)
+            write_to_file(vacancies_file, vacancies)
+    if unknown_areas_ids:
+        update_areas_with_unknown_ids(snapshot, unknown_areas_ids)
+    log_http_latencies()
+    log_stage_counters("http")
+    log_stage_counters("ingest")
+    log_stage_counters("database")
+    if high_water_mark:
+        logger.info(f"\nNewest vacancy: id={high_water_mark['id']}, \
+published at {high_water_mark['published_at']}")
+        config["high_water_mark"] = high_water_mark
+        config["url_params"]["date_from"] = get_local_date(
+            high_water_mark["published_at"])
+    else:
+        config["url_params"]["date_from"] = date_current
+    save_state(snapshot, config)
+    got_vacancies = len(vacancies_ids)
     if "period" in filters:
-        print(f"\n\nFound: {found_vacancies} vacancies \
+        logger.info(f"\n\nFound: {found_vacancies} vacancies \
 for period of {filters['period']} days.")
     elif "date_from" in filters:
-        print(f"\n\nFound: {found_vacancies} vacancies \
+        logger.info(f"\n\nFound: {found_vacancies} vacancies \
 from {format(filters['date_from'])}.")
     else:
-        print(
+        logger.error(
             "\n\nNo `period` or `date_from` in `config.yaml > url_params`\n\n")
         raise AttributeError
     if found_vacancies:
-        print(f"Got: {got_vacancies} vacancies \
+        logger.info(f"Got: {got_vacancies} vacancies \
 ({round(got_vacancies/found_vacancies*100, 2)}%)")
     else:
-        print(f"Got: {got_vacancies} vacancies (0%)")
-    if found_vacancies > got_vacancies:
-        print(f"\nYou can get more vacancies by:\n\
+        logger.info(f"Got: {got_vacancies} vacancies (0%)")
+    # Incremental mode loads all found vacancies or stops at stored ones.
+    if found_vacancies > got_vacancies and is_incremental:
+        logger.info(f"Other {found_vacancies - got_vacancies} found vacancies \
+are already stored.")
+    elif found_vacancies > got_vacancies:
+        logger.warning(f"\nYou can get more vacancies by:\n\
     1. Scheduling parse more often.\n\
     2. Adding more filter params to `config.yaml > url_params`.\n\
     3. Changing region\n\
@@ -83,51 +150,260 @@ from {format(filters['date_from'])}.")
 ")
     return ()
 
-def load_vacancies(headers, filters):
+def get_high_water_mark(items, high_water_mark=None):
+    """
+    Get the newest (`published_at`, `id`) among hh `items`
+    and previous `high_water_mark`.
+    Return dict {"published_at": str, "id": int} or None if nothing to compare.
+    """
+    in_tests.test_var_type(items, "items", list)
+    in_tests.test_var_type(
+        high_water_mark, "high_water_mark", (dict, type(None)))
+
+    marks = [(datetime.datetime.strptime(
+        item["published_at"], "%Y-%m-%dT%H:%M:%S%z"), int(item["id"]),
+              item["published_at"]) for item in items]
+    if high_water_mark:
+        marks.append((datetime.datetime.strptime(
+            high_water_mark["published_at"], "%Y-%m-%dT%H:%M:%S%z"),
+                      high_water_mark["id"], high_water_mark["published_at"]))
+    if not marks:
+        return (None)
+    _, id_, published_at = max(marks)
+    return ({"published_at": published_at, "id": id_})
+
+def get_local_date(published_at):
+    """
+    Convert hh `published_at` to local time without timezone,
+    the format of `url_params > date_from` (see `split_vacancies_filters`).
+    """
+    in_tests.test_var_type(published_at, "published_at", str)
+    return (datetime.datetime.strptime(published_at, "%Y-%m-%dT%H:%M:%S%z")
+            .astimezone().replace(tzinfo=None).isoformat())
+
+def select_stored_vacancies_ids(snapshot, ids):
+    """
+    Select `ids` which are already in `vacancies_table`.
+    `ids` == list of vacancies ids.
+    """
+    database = snapshot.database
+    vacancies_table = snapshot.tables.vacancies_table
+    in_tests.test_database_name(database)
+    in_tests.test_table_name(vacancies_table)
+    in_tests.test_list_data_type(ids)
+
+    if not ids or not is_table_exists(database, vacancies_table):
+        return (set())
+    connection = get_connection(database)
+    cursor = connection.cursor()
+    query = f"SELECT id FROM {vacancies_table} \
+WHERE id IN ({', '.join('?' * len(ids))})"
+    stored_ids = set(row[0] for row in cursor.execute(query, ids))
+    cursor.close()
+    return (stored_ids)
+
+def load_new_vacancies_pages(snapshot, filters, first_page):
+    """
+    Yield pages sorted by publication date one by one
+    and stop as soon as a page holds only stored vacancies.
+    """
+    in_tests.test_dict_data_type(filters)
+    in_tests.test_var_type(first_page, "first_page", dict)
+
+    vacancies = first_page
+    page = 0
+    while True:
+        ids = [int(item["id"]) for item in vacancies["items"]]
+        if ids and len(select_stored_vacancies_ids(snapshot, ids)) == len(ids):
+            logger.info(f"    All vacancies at page {page} are already stored. \
+Stop loading.")
+            break
+        yield (vacancies)
+        page += 1
+        if vacancies["pages"] <= page:
+            break
+        vacancies = load_vacancies(snapshot, dict(filters, page=page))
+    return ()
+
+def is_vacancies_slice_complete(vacancies):
+    """
+    Check if all found vacancies fit into returned pages.
+    hh returns at most 2000 vacancies for one query.
+    """
+    in_tests.test_var_type(vacancies, "vacancies", dict)
+    return (vacancies["found"] <= vacancies["pages"] * vacancies["per_page"])
+
+def split_vacancies_filters(filters, date_current, period):
+    """
+    Split `filters` into two ones by halving dates window.
+    If window is too short to be halved, split `area` list instead.
+    Return empty list if `filters` can't be split.
+    """
+    in_tests.test_dict_data_type(filters)
+    in_tests.test_var_type(date_current, "date_current", str)
+
+    date_to = datetime.datetime.fromisoformat(
+        filters.get("date_to", date_current))
+    if "date_from" in filters:
+        date_from = datetime.datetime.fromisoformat(filters["date_from"])
+    else:
+        date_from = date_to - datetime.timedelta(days=period)
+    window = date_to - date_from
+    areas = filters.get("area", [])
+
+    if window > datetime.timedelta(seconds=1):
+        date_middle = date_from + datetime.timedelta(
+            seconds=math.ceil(window.total_seconds() / 2))
+        splitted_filters = [
+            dict(filters, date_from=date_from.isoformat(),
+                 date_to=date_middle.isoformat()),
+            dict(filters, date_from=date_middle.isoformat(),
+                 date_to=date_to.isoformat())
+        ]
+    elif len(areas) > 1:
+        areas_middle = len(areas) // 2
+        splitted_filters = [
+            dict(filters, area=areas[:areas_middle]),
+            dict(filters, area=areas[areas_middle:])
+        ]
+    else:
+        splitted_filters = []
+    for splitted_filter in splitted_filters:
+        splitted_filter.pop("period", None)
+    return (splitted_filters)
+
+def load_vacancies_slices(
+        snapshot, executor, filters, first_page, date_current, period):
+    """
+    Split `filters` recursively until each slice fits under hh results cap.
+    Every split level is loaded in parallel with `executor`.
+    Return list of tuples (slice_filters, slice_first_page).
+    """
+    in_tests.test_dict_data_type(filters)
+    in_tests.test_var_type(first_page, "first_page", dict)
+
+    slices = []
+    pending = [(filters, first_page)]
+    while pending:
+        splitted_filters = []
+        for slice_filters, slice_page in pending:
+            if is_vacancies_slice_complete(slice_page):
+                slices.append((slice_filters, slice_page))
+                continue
+            slice_splitted_filters = split_vacancies_filters(
+                slice_filters, date_current, period)
+            if slice_splitted_filters:
+                splitted_filters += slice_splitted_filters
+            else:
+                logger.warning(f"    Can't split slice {slice_filters} any more. \
+Got only {slice_page['pages'] * slice_page['per_page']} vacancies \
+of {slice_page['found']}.")
+                slices.append((slice_filters, slice_page))
+        if splitted_filters:
+            logger.info(f"    Splitting query into {len(splitted_filters)} slices \
+to get past hh results cap...")
+        splitted_pages = executor.map(
+            partial(load_vacancies, snapshot), splitted_filters)
+        pending = list(zip(splitted_filters, splitted_pages))
+    return (slices)
+
+def load_vacancies(snapshot, filters):
     """
     Get vacancies under `filters`.
+    `snapshot` == `config.ConfigSnapshot`.
     """
-    in_tests.test_dict_data_type(headers)
-    print ("    Loading vacancies from hh...")
+    in_tests.test_dict_data_type(filters)
+    logger.debug("    Loading vacancies from hh...")
 
     url = "https://api.hh.ru/vacancies"
-    response = requests.get(url, headers=headers, params=filters)
+    response = http_get(snapshot, url, params=filters)
     vacancies = response.json()
-    out_tests.test_load_vacancies(response, vacancies, filters)
+    out_tests.test_is_status_code_200(response)
+    if is_validated("load_vacancies"):
+        out_tests.test_load_vacancies(response, vacancies, filters)
     return (vacancies)
 
-def create_vacancies_generator(vacancies, parent_key = ""):
+# Non-vacancies tables data of a vacancy (see `add_*_row` functions).
+TABLES_CACHE_KEYS = ("id", "area_id", "address_city", "address_street",
+    "address_metro_stations_station_id", "address_metro_stations_station_name",
+    "address_metro_stations_line_name", "address_metro_stations_lat",
+    "address_metro_stations_lng", "employer_id", "employer_name",
+    "employer_url", "employer_alternate_url", "employer_logo_urls_original",
+    "employer_logo_urls_240", "employer_logo_urls_90",
+    "employer_vacancies_url", "employer_trusted")
+
+# We don’t write these keys to vacancies table
+# because they are in some other one.
+VACANCY_SKIP_KEYS = frozenset(("area_name", "area_url",
+    "address_metro_station_name", "address_metro_line_name",
+    "address_metro_station_id", "address_metro_line_id", "address_metro_lat",
+    "address_metro_lng", "address_metro_stations_station_name",
+    "address_metro_stations_line_name", "address_metro_stations_station_id",
+    "address_metro_stations_line_id", "address_metro_stations_lat",
+    "address_metro_stations_lng", "employer_name", "employer_url",
+    "employer_alternate_url", "employer_logo_urls_original",
+    "employer_logo_urls_90", "employer_logo_urls_240",
+    "employer_vacancies_url", "employer_trusted"))
+
+def flatten_vacancy(item, parent_key="", flat_vacancy=None):
     """
-    Create vacancies iterator to flatten multilevel json
-    into single-level database table.
+    Flatten multilevel hh vacancy into single-level dict {key: value}.
+    Nested keys are joined with `_`. List items share their parent key,
+    so the last item values win.
+    Text is lowercased to have case-insensitive search
+    (`COLLATE NOCASE` doesn't work for cyrillic).
     """
-    in_tests.test_var_type(vacancies, "vacancies", (dict, list))
+    if flat_vacancy is None:
+        flat_vacancy = {}
+    for key, value in item.items():
+        value_type = type(value)
+        if value_type is str:
+            flat_vacancy[parent_key + key] = value.lower()
+        elif value_type is dict:
+            flatten_vacancy(value, parent_key + key + "_", flat_vacancy)
+        elif value_type is list:
+            for list_item in value:
+                if type(list_item) is dict:
+                    flatten_vacancy(
+                        list_item, parent_key + key + "_", flat_vacancy)
+                else:
+                    flat_vacancy[parent_key + key] = list_item
+        else:
+            flat_vacancy[parent_key + key] = value
+    return (flat_vacancy)
 
-    if isinstance(vacancies, dict):
-        for key, value in vacancies.items():
-            if isinstance(value, (dict, list)):
-                yield from create_vacancies_generator(value, parent_key+key+"_")
-            else:
-                yield (parent_key+key, value)
-    elif isinstance(vacancies, list):
-        for item in vacancies:
-            yield from create_vacancies_generator(item, parent_key)
-    else:
-        print (f"\n\n    Unhandled data type: {type(vacancies)}\n\n")
-        raise TypeError
+def compile_vacancy_keys(vacancies_columns_names):
+    """
+    Get set of flat vacancy keys which don't need a new vacancies table column:
+    existing columns and keys of other tables.
+    Compile it once per vacancies table schema.
+    """
+    in_tests.test_var_type(
+        vacancies_columns_names, "vacancies_columns_names", list)
+    return (frozenset(vacancies_columns_names) | VACANCY_SKIP_KEYS)
 
-def create_vacancies_tables(config):
+def create_vacancy_records(flat_vacancy):
+    """
+    Split flat vacancy into vacancies table row (no None values)
+    and tables cache for streets, metro stations and employers rows.
+    """
+    vacancy = {key: value for key, value in flat_vacancy.items()
+               if value is not None and key not in VACANCY_SKIP_KEYS}
+    tables_cache = {key: flat_vacancy.get(key) for key in TABLES_CACHE_KEYS}
+    return (vacancy, tables_cache)
+
+def create_vacancies_tables(snapshot):
     """
     Create vacancies' tables.
     """
-    database = deepcopy(config["database"])
-    areas_table = deepcopy(config["tables"]["areas_table"])
-    vacancies_table = deepcopy(config["tables"]["vacancies_table"])
-    streets_table = deepcopy(config["tables"]["streets_table"])
-    metro_stations_table = deepcopy(config["tables"]["metro_stations_table"])
-    employers_table = deepcopy(config["tables"]["employers_table"])
+    database = snapshot.database
+    areas_table = snapshot.tables.areas_table
+    vacancies_table = snapshot.tables.vacancies_table
+    streets_table = snapshot.tables.streets_table
+    metro_stations_table = snapshot.tables.metro_stations_table
+    employers_table = snapshot.tables.employers_table
     vacancies_metro_stations_table = \
-        deepcopy(config["tables"]["vacancies_metro_stations_table"])
+        snapshot.tables.vacancies_metro_stations_table
     in_tests.test_database_name(database)
     in_tests.test_table_name(areas_table)
     in_tests.test_table_name(vacancies_table)
@@ -203,37 +479,36 @@ def create_vacancies_tables(config):
      ])
     return ()
 
-def write_streets_to_streets_table(config, tables_cache):
+def add_street_row(tables_cache, streets_rows):
     """
-    Write `area_id > city > stree` row to `streets` table.
+    Add `area_id > city > stree` row to `streets` rows buffer.
     """
-    database = deepcopy(config["database"])
-    streets_table = deepcopy(config["tables"]["streets_table"])
-    in_tests.test_write_to_database_from_dict(
-        database, streets_table, tables_cache)
+    if is_validated("add_street_row"):
+        in_tests.test_var_type(tables_cache, "tables_cache", dict)
+        in_tests.test_var_type(streets_rows, "streets_rows", list)
 
     area_id = tables_cache["area_id"]
     city_name = tables_cache["address_city"]
     street_name = tables_cache["address_street"]
 
     if city_name or street_name:
-        write_to_database(database, streets_table, {
+        streets_rows.append({
             "area_id": area_id,
             "city_name": city_name,
             "street_name": street_name
         })
     return ()
 
-def write_stations_to_metro_stations_table(config, tables_cache):
+def add_metro_station_row(tables_cache, metro_stations_rows):
     """
-    Write `station_id > station_name > line_name > station_lat > station_lng`
-    row to `metro_stations` table.
+    Add `station_id > station_name > line_name > station_lat > station_lng`
+    row to `metro_stations` rows buffer.
     Vacancy can have several metro stations. Only the last one will be written.
     """
-    database = deepcopy(config["database"])
-    metro_stations_table = deepcopy(config["tables"]["metro_stations_table"])
-    in_tests.test_write_to_database_from_dict(
-        database, metro_stations_table, tables_cache)
+    if is_validated("add_metro_station_row"):
+        in_tests.test_var_type(tables_cache, "tables_cache", dict)
+        in_tests.test_var_type(
+            metro_stations_rows, "metro_stations_rows", list)
 
     station_id = tables_cache["address_metro_stations_station_id"]
     station_name = tables_cache["address_metro_stations_station_name"]
@@ -242,7 +517,7 @@ def write_stations_to_metro_stations_table(config, tables_cache):
     station_lng = tables_cache["address_metro_stations_lng"]
 
     if station_id:
-        write_to_database(database, metro_stations_table, {
+        metro_stations_rows.append({
             "station_id": station_id,
             "station_name": station_name,
             "line_name": line_name,
@@ -251,37 +526,36 @@ def write_stations_to_metro_stations_table(config, tables_cache):
         })
     return ()
 
-def write_to_vacancies_metro_stations_table(config, tables_cache):
+def add_vacancy_metro_station_row(tables_cache, vacancies_metro_stations_rows):
     """
-    Write `vacancy_id > metro_station_id` to `vacancies_metro_stations`.
+    Add `vacancy_id > metro_station_id` row to `vacancies_metro_stations`
+    rows buffer.
     Vacancy can have several metro stations. Only the last one will be written.
     """
-    database = deepcopy(config["database"])
-    vacancies_metro_stations_table = \
-        deepcopy(config["tables"]["vacancies_metro_stations_table"])
-    in_tests.test_write_to_database_from_dict(
-        database, vacancies_metro_stations_table, tables_cache)
+    if is_validated("add_vacancy_metro_station_row"):
+        in_tests.test_var_type(tables_cache, "tables_cache", dict)
+        in_tests.test_var_type(vacancies_metro_stations_rows, \
+                               "vacancies_metro_stations_rows", list)
 
     vacancy_id = tables_cache["id"]
     station_id = tables_cache["address_metro_stations_station_id"]
 
     if station_id:
-        write_to_database(database, vacancies_metro_stations_table, {
+        vacancies_metro_stations_rows.append({
             "vacancy_id": vacancy_id,
             "metro_station_id": station_id
         })
     return ()
 
-def write_employers_to_employers_table(config, tables_cache):
+def add_employer_row(tables_cache, employers_rows):
     """
-    Write `id > name > url > alternate_url > logo_urls_original >
+    Add `id > name > url > alternate_url > logo_urls_original >
     logo_urls_240 > logo_urls_90 > vacancies_url > trusted` row
-    to `employers` table.
+    to `employers` rows buffer.
     """
-    database = deepcopy(config["database"])
-    employers_table = deepcopy(config["tables"]["employers_table"])
-    in_tests.test_write_to_database_from_dict(
-        database, employers_table, tables_cache)
+    if is_validated("add_employer_row"):
+        in_tests.test_var_type(tables_cache, "tables_cache", dict)
+        in_tests.test_var_type(employers_rows, "employers_rows", list)
 
     id_ = tables_cache["employer_id"]
     name = tables_cache["employer_name"]
@@ -294,7 +568,7 @@ def write_employers_to_employers_table(config, tables_cache):
     is_trusted = tables_cache["employer_trusted"]
 
     if id_:
-        write_to_database(database, employers_table, {
+        employers_rows.append({
             "id": id_,
             "name": name,
             "url": url,
@@ -307,93 +581,182 @@ def write_employers_to_employers_table(config, tables_cache):
         })
     return ()
 
-def write_vacancies_to_database(config, vacancies_generator):
+def add_vacancy_rows(snapshot, vacancy, tables_cache, rows):
+    """
+    Add vacancy and its streets, metro stations and employer rows
+    to page rows buffers.
+    `rows` == dict {table: list of rows}
+    """
+    tables = snapshot.tables
+
+    add_street_row(tables_cache, rows[tables.streets_table])
+    add_metro_station_row(tables_cache, rows[tables.metro_stations_table])
+    add_employer_row(tables_cache, rows[tables.employers_table])
+    add_vacancy_metro_station_row(
+        tables_cache, rows[tables.vacancies_metro_stations_table])
+    rows[tables.vacancies_table].append(vacancy)
+    return ()
+
+def flush_rows_to_database(database, rows):
+    """
+    Write page rows buffers to database in one transaction
+    with one `executemany` per table.
+    `rows` == dict {table: list of rows}, tables are written in dict order.
+    Return dict {table: database changes}.
+    """
+    in_tests.test_database_name(database)
+    in_tests.test_var_type(rows, "rows", dict)
+
+    database_changes = dict.fromkeys(rows, 0)
+    with transaction(database):
+        for table, table_rows in rows.items():
+            if table_rows:
+                database_changes[table] = write_many_to_database(
+                    database, table, table_rows)
+    return (database_changes)
+
+def get_vacancy_hash(vacancy):
+    """
+    Get hash of vacancy content.
+    `is_sent` and `content_hash` keys are not content and are skipped.
+    """
+    if is_validated("get_vacancy_hash"):
+        in_tests.test_var_type(vacancy, "vacancy", dict)
+
+    content = {key: value for key, value in vacancy.items()
+               if key not in ("is_sent", "content_hash")}
+    content_hash = hashlib.sha1(json.dumps(
+        content, sort_keys=True, ensure_ascii=False).encode("utf8")).hexdigest()
+    return (content_hash)
+
+def is_same_database_value(value, stored_value):
+    """
+    Compare python value with the one read from database.
+    Column affinity can store `True` as 1 or 1 as "1", so compare as strings.
+    """
+    if value is None or stored_value is None:
+        return (value is stored_value)
+    if isinstance(value, bool):
+        value = int(value)
+    return (str(value) == str(stored_value))
+
+def upsert_vacancies(database, vacancies_table, vacancies):
+    """
+    Insert new vacancies with `is_sent` = 0, update only changed columns of
+    changed vacancies and skip unchanged ones. `is_sent` is never reset.
+    Vacancy is unchanged if its `content_hash` is equal to the stored one.
+    Return tuple (inserted, updated, unchanged) vacancies numbers.
+    """
+    in_tests.test_var_type(vacancies, "vacancies", list)
+    in_tests.test_var_len_more_than(vacancies, "vacancies", 0)
+    if is_validated("upsert_vacancies"):
+        in_tests.test_write_many_to_database(
+            database, vacancies_table, vacancies)
+
+    new_vacancies = []
+    updated_counter = 0
+    unchanged_counter = 0
+    with transaction(database) as connection:
+        cursor = connection.cursor()
+        ids = [int(vacancy["id"]) for vacancy in vacancies]
+        query = f"SELECT * FROM {vacancies_table} \
+WHERE id IN ({', '.join('?' * len(ids))})"
+        cursor.execute(query, ids)
+        columns = [column[0] for column in cursor.description]
+        stored_vacancies = {row[0]: dict(zip(columns, row)) for row in cursor}
+        total_changes = connection.total_changes
+
+        for vacancy in vacancies:
+            vacancy = dict(vacancy, content_hash=get_vacancy_hash(vacancy))
+            stored_vacancy = stored_vacancies.get(int(vacancy["id"]))
+            if stored_vacancy is None:
+                vacancy["is_sent"] = 0
+                new_vacancies.append(vacancy)
+            elif stored_vacancy["content_hash"] == vacancy["content_hash"]:
+                unchanged_counter += 1
+            else:
+                # Missing keys are None values, so compare all stored columns.
+                changed_columns = {
+                    column: vacancy.get(column) for column in columns
+                    if column not in ("id", "is_sent") and
+                    not is_same_database_value(
+                        vacancy.get(column), stored_vacancy[column])}
+                query = f"UPDATE {vacancies_table} SET \
+{', '.join(f'{column} = ?' for column in changed_columns)} WHERE id = ?"
+                cursor.execute(
+                    query, list(changed_columns.values()) + [vacancy["id"]])
+                updated_counter += 1
+        database_changes = connection.total_changes - total_changes
+        cursor.close()
+        out_tests.test_write_to_database(database_changes, updated_counter)
+
+        if new_vacancies:
+            write_many_to_database(database, vacancies_table, new_vacancies)
+    logger.debug(f"    Vacancies: {len(new_vacancies)} new, {updated_counter} \
+updated, {unchanged_counter} unchanged.")
+    count_stage("ingest", "new", len(new_vacancies))
+    count_stage("ingest", "updated", updated_counter)
+    count_stage("ingest", "unchanged", unchanged_counter)
+    return (len(new_vacancies), updated_counter, unchanged_counter)
+
+def write_vacancies_to_database(snapshot, items, areas_ids):
     """
-    Iterate over vacancies generator and fill `vacancies` table.
+    Flatten hh vacancies `items`, buffer one page of rows per table
+    and flush them to database in one transaction.
+    `snapshot` == `config.ConfigSnapshot`.
+    `areas_ids` == set of ids in `areas_table`.
+    Return set of vacancies areas ids which are not in `areas_ids`.
     """
-    database = deepcopy(config["database"])
-    vacancies_table = deepcopy(config["tables"]["vacancies_table"])
+    database = snapshot.database
+    vacancies_table = snapshot.tables.vacancies_table
+    streets_table = snapshot.tables.streets_table
+    metro_stations_table = snapshot.tables.metro_stations_table
+    employers_table = snapshot.tables.employers_table
+    vacancies_metro_stations_table = \
+        snapshot.tables.vacancies_metro_stations_table
     in_tests.test_database_name(database)
     in_tests.test_table_name(vacancies_table)
-    in_tests.test_var_type(
-        vacancies_generator, "vacancies_generator", types.GeneratorType)
-    print (f"    Writing vacancies to `{database} > {vacancies_table}`...")
+    in_tests.test_var_type(items, "items", list)
+    in_tests.test_var_len_more_than(items, "items", 0)
+    in_tests.test_var_type(areas_ids, "areas_ids", set)
+    logger.debug(f"    Writing vacancies to `{database} > {vacancies_table}`...")
+    count_stage("ingest", "pages")
 
-    create_vacancies_tables(config)
+    create_vacancies_tables(snapshot)
 
     vacancies_columns_names = get_table_columns_names(database, vacancies_table)
-    vacancy = {}
-    vacancy_counter = 0
-    database_changes = 0
-
-    # Accumulate non-vacances tables data.
-    # Its values are reseted to None every vacancy.
-    tables_cache_keys = ["id", "area_id", "address_city", "address_street", \
-"address_metro_stations_station_id", "address_metro_stations_station_name", \
-"address_metro_stations_line_name", "address_metro_stations_lat", \
-"address_metro_stations_lng", "employer_id", "employer_name", "employer_url", \
-"employer_alternate_url", "employer_logo_urls_original", \
-"employer_logo_urls_240", "employer_logo_urls_90", "employer_vacancies_url", \
-"employer_trusted"]
-    tables_cache = dict.fromkeys(tables_cache_keys)
-
-    # We don’t write these keys to vacancies table
-    # because they are in some other one.
-    skip_keys = ["area_name", "area_url", "address_metro_station_name", \
-"address_metro_line_name", "address_metro_station_id", \
-"address_metro_line_id", "address_metro_lat", "address_metro_lng", \
-"address_metro_stations_station_name", "address_metro_stations_line_name", \
-"address_metro_stations_station_id", "address_metro_stations_line_id", \
-"address_metro_stations_lat", "address_metro_stations_lng", "employer_name", \
-"employer_url", "employer_alternate_url", "employer_logo_urls_original", \
-"employer_logo_urls_90", "employer_logo_urls_240", "employer_vacancies_url", \
-"employer_trusted"
-    ]
-
-    for item in vacancies_generator:
-        key, value = item[0], item[1]
-
-        # Lowercase text to have case-insensitive search.
-        # `COLLATE NOCASE` doesn't work for cyrillic.
-        try:
-            value = value.lower()
-        except AttributeError:
-            pass
-
-        if key not in vacancies_columns_names and key not in skip_keys:
-            column = [(f"{key} TEXT")]
-            create_table_columns(database, vacancies_table, column)
-            vacancies_columns_names.append(key)
-
-        if key != "id" or vacancy == {}:
-            tables_cache[key] = value
-            if key not in skip_keys and value != None:
-                vacancy[key] = value
-        else:
-            vacancy["is_sent"] = 0
-            check_if_area_id_is_in_areas_table(
-                config, int(tables_cache["area_id"]))
-            write_streets_to_streets_table(config, tables_cache)
-            write_stations_to_metro_stations_table(config, tables_cache)
-            write_employers_to_employers_table(config, tables_cache)
-            write_to_vacancies_metro_stations_table(config, tables_cache)
-
-            database_changes += write_to_database(
-                database, vacancies_table, vacancy)
-            vacancy_counter += 1
-            vacancy = {}
-            tables_cache = dict.fromkeys(tables_cache_keys)
-            vacancy[key] = value
-            tables_cache[key] = value
-
-    vacancy["is_sent"] = 0
-    check_if_area_id_is_in_areas_table(
-        config, int(tables_cache["area_id"]))
-    write_streets_to_streets_table(config, tables_cache)
-    write_stations_to_metro_stations_table(config, tables_cache)
-    write_employers_to_employers_table(config, tables_cache)
-    write_to_vacancies_metro_stations_table(config, tables_cache)
-    database_changes += write_to_database(database, vacancies_table, vacancy)
-    vacancy_counter += 1
-    out_tests.test_write_to_database(database_changes, vacancy_counter)
-    return ()
+    if "content_hash" not in vacancies_columns_names:
+        create_table_columns(database, vacancies_table, ["content_hash TEXT"])
+        vacancies_columns_names.append("content_hash")
+    known_keys = compile_vacancy_keys(vacancies_columns_names)
+    unknown_areas_ids = set()
+
+    # Page rows buffers. Order matters: parent tables first.
+    rows = {
+        streets_table: [],
+        metro_stations_table: [],
+        employers_table: [],
+        vacancies_table: [],
+        vacancies_metro_stations_table: []
+    }
+
+    for item in items:
+        flat_vacancy = flatten_vacancy(item)
+        new_keys = flat_vacancy.keys() - known_keys
+        if new_keys:
+            new_keys = [key for key in flat_vacancy if key in new_keys]
+            create_table_columns(database, vacancies_table,
+                                 [f"{key} TEXT" for key in new_keys])
+            vacancies_columns_names += new_keys
+            known_keys = compile_vacancy_keys(vacancies_columns_names)
+        vacancy, tables_cache = create_vacancy_records(flat_vacancy)
+        unknown_areas_ids.add(int(tables_cache["area_id"]))
+        add_vacancy_rows(snapshot, vacancy, tables_cache, rows)
+    unknown_areas_ids -= areas_ids
+
+    vacancies_rows = rows.pop(vacancies_table)
+    with transaction(database):
+        flush_rows_to_database(database, rows)
+        upserted = upsert_vacancies(database, vacancies_table, vacancies_rows)
+    out_tests.test_write_to_database(sum(upserted), len(items))
+    return (unknown_areas_ids)